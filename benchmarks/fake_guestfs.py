@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Stand-in for libguestfs python bindings used by the benchmarks.
+
+Guest filesystem is a temporary directory on host, appliance costs are
+simulated with configurable sleeps. Only the calls made by this collection
+are implemented.
+"""
+
+import fnmatch
+import glob
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+# Seconds slept by simulated operations, 'transfer_mb' is per MiB transferred
+LATENCIES = {
+    'launch': 0.5,
+    'inspect': 0.2,
+    'mount': 0.02,
+    'call': 0.002,
+    'transfer_mb': 0.005,
+    'sync': 0.05,
+    'shutdown': 0.1,
+}
+
+# Number of applications reported by inspect_list_applications2
+APPLICATIONS = 1500
+
+# Filesystems reported by inspect_get_mountpoints, root device is mounted on '/'
+MOUNTPOINTS = {}
+
+# Counters shared by all handles, reset by benchmark scenarios
+STATS = {
+    'launches': 0,
+    'inspections': 0,
+    'calls': 0,
+}
+
+EVENT_PROGRESS = 0x0001
+
+
+def reset_stats():
+    for key in STATS:
+        STATS[key] = 0
+
+
+def _sleep(name, factor=1):
+    delay = LATENCIES.get(name, 0) * factor
+    if delay:
+        time.sleep(delay)
+
+
+class GuestFS(object):
+
+    def __init__(self, python_return_dict=False):
+        self.sysroot = None
+        self.drives = []
+        self.settings = {}
+        self.launched = False
+        self.mounted = []
+        self.callbacks = []
+
+    # Appliance lifecycle
+
+    def set_network(self, enabled):
+        self.settings['network'] = enabled
+
+    def set_backend(self, backend):
+        self.settings['backend'] = backend
+
+    def set_memsize(self, memsize):
+        self.settings['memsize'] = memsize
+
+    def set_smp(self, smp):
+        self.settings['smp'] = smp
+
+    def set_event_callback(self, callback, events):
+        self.callbacks.append((callback, events))
+        return len(self.callbacks) - 1
+
+    def disk_format(self, filename):
+        return 'qcow2'
+
+    def disk_create(self, filename, format, size, backingfile=None, backingformat=None):
+        open(filename, 'wb').close()
+
+    def add_drive_opts(self, filename, **kwargs):
+        self.drives.append((filename, kwargs))
+
+    def add_drive_scratch(self, size):
+        self.drives.append((None, {'size': size}))
+
+    def list_devices(self):
+        return ['/dev/sd{}'.format(chr(ord('a') + index)) for index in range(len(self.drives))]
+
+    def launch(self):
+        _sleep('launch')
+        STATS['launches'] += 1
+        self.sysroot = tempfile.mkdtemp(prefix='fake-guestfs-')
+        self.launched = True
+
+    def sync(self):
+        _sleep('sync')
+
+    def umount_all(self):
+        self.mounted = []
+
+    def shutdown(self):
+        _sleep('shutdown')
+        self.launched = False
+
+    def close(self):
+        if self.sysroot:
+            shutil.rmtree(self.sysroot, ignore_errors=True)
+            self.sysroot = None
+
+    # Inspection
+
+    def inspect_os(self):
+        _sleep('inspect')
+        STATS['inspections'] += 1
+        return ['/dev/sda1']
+
+    def inspect_get_mountpoints(self, root):
+        mountpoints = dict(MOUNTPOINTS)
+        mountpoints['/'] = root
+        return mountpoints
+
+    def inspect_get_type(self, root):
+        return 'linux'
+
+    def inspect_get_distro(self, root):
+        return 'fedora'
+
+    def inspect_get_package_management(self, root):
+        return 'dnf'
+
+    def inspect_get_major_version(self, root):
+        return 34
+
+    def inspect_get_minor_version(self, root):
+        return 0
+
+    def inspect_get_arch(self, root):
+        return 'x86_64'
+
+    def inspect_list_applications2(self, root):
+        self._call()
+        return [{
+            'app2_name': 'package{}'.format(index),
+            'app2_epoch': 0,
+            'app2_version': '1.0.{}'.format(index),
+            'app2_release': '1.fc34',
+            'app2_arch': 'x86_64',
+            'app2_source_package': 'package{}'.format(index),
+        } for index in range(APPLICATIONS)]
+
+    # Filesystems
+
+    def mount(self, device, mountpoint):
+        _sleep('mount')
+        self.mounted.append((device, mountpoint))
+
+    mount_ro = mount
+
+    def umount(self, pathordevice):
+        self.mounted = [(device, mountpoint) for device, mountpoint in self.mounted
+                        if pathordevice not in (device, mountpoint)]
+
+    def mkfs(self, fstype, device):
+        _sleep('mount')
+
+    def mounts(self):
+        return [device for device, mountpoint in self.mounted]
+
+    def mountpoints(self):
+        return dict((device, mountpoint) for device, mountpoint in self.mounted)
+
+    # Commands, nothing is executed
+
+    def _call(self):
+        _sleep('call')
+        STATS['calls'] += 1
+
+    def sh(self, command):
+        self._call()
+        return ''
+
+    def sh_lines(self, command):
+        self._call()
+        return []
+
+    def command(self, arguments):
+        self._call()
+        return ''
+
+    # Files, stored under a temporary directory on host
+
+    def _path(self, path):
+        return os.path.join(self.sysroot, path.lstrip('/'))
+
+    def _transfer(self, path):
+        if os.path.isfile(path):
+            size = os.path.getsize(path)
+            _sleep('transfer_mb', size / 1048576.0)
+            for callback, events in self.callbacks:
+                if events & EVENT_PROGRESS:
+                    callback(EVENT_PROGRESS, 0, b'', [0, 0, size, size])
+
+    def is_file(self, path):
+        self._call()
+        return os.path.isfile(self._path(path))
+
+    def is_dir(self, path):
+        self._call()
+        return os.path.isdir(self._path(path))
+
+    def exists(self, path):
+        self._call()
+        return os.path.exists(self._path(path))
+
+    def mkdir_p(self, path):
+        self._call()
+        if not os.path.isdir(self._path(path)):
+            os.makedirs(self._path(path))
+
+    def rm_f(self, path):
+        self._call()
+        if os.path.isfile(self._path(path)):
+            os.unlink(self._path(path))
+
+    def rm_rf(self, path):
+        self._call()
+        shutil.rmtree(self._path(path), ignore_errors=True)
+
+    def touch(self, path):
+        self._call()
+        open(self._path(path), 'a').close()
+        os.utime(self._path(path), None)
+
+    def write(self, path, content):
+        self._call()
+        with open(self._path(path), 'wb') as f:
+            f.write(content)
+
+    def read_file(self, path):
+        self._call()
+        with open(self._path(path), 'rb') as f:
+            return f.read()
+
+    def read_lines(self, path):
+        return self.read_file(path).decode('utf-8').splitlines()
+
+    def glob_expand(self, pattern):
+        self._call()
+        return ['/' + os.path.relpath(path, self.sysroot) for path in glob.glob(self._path(pattern))]
+
+    def _stat(self, path):
+        stat = os.lstat(path)
+        return {'st_mode': stat.st_mode, 'st_uid': stat.st_uid, 'st_gid': stat.st_gid, 'st_size': stat.st_size,
+                'st_atime_sec': int(stat.st_atime), 'st_mtime_sec': int(stat.st_mtime)}
+
+    def lstatns(self, path):
+        self._call()
+        return self._stat(self._path(path))
+
+    def lstatnslist(self, path, names):
+        self._call()
+        return [self._stat(os.path.join(self._path(path), name)) for name in names]
+
+    def utimens(self, path, atsecs, atnsecs, mtsecs, mtnsecs):
+        self._call()
+        os.utime(self._path(path), (atsecs, mtsecs))
+
+    def chmod(self, mode, path):
+        self._call()
+        os.chmod(self._path(path), mode)
+
+    def lchown(self, owner, group, path):
+        self._call()
+
+    def checksum(self, algorithm, path):
+        self._call()
+        digest = hashlib.new(algorithm)
+        with open(self._path(path), 'rb') as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+
+    def upload(self, filename, remotefilename):
+        self._call()
+        self._transfer(filename)
+        shutil.copyfile(filename, self._path(remotefilename))
+
+    def download(self, remotefilename, filename):
+        self._call()
+        self._transfer(self._path(remotefilename))
+        shutil.copyfile(self._path(remotefilename), filename)
+
+    def copy_in(self, localpath, remotedir):
+        self._call()
+        target = os.path.join(self._path(remotedir), os.path.basename(localpath.rstrip('/')))
+        if os.path.isdir(localpath):
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            shutil.copytree(localpath, target)
+        else:
+            shutil.copyfile(localpath, target)
+
+    def copy_out(self, remotepath, localdir):
+        self._call()
+        source = self._path(remotepath)
+        target = os.path.join(localdir, os.path.basename(source.rstrip('/')))
+        if os.path.isdir(source):
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            shutil.copytree(source, target)
+        else:
+            shutil.copyfile(source, target)
+
+    def find(self, directory):
+        self._call()
+        root = self._path(directory)
+        names = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                names.append(os.path.relpath(os.path.join(dirpath, name), root))
+        return sorted(names)
+
+    def checksums_out(self, csumtype, directory, sumsfile):
+        self._call()
+        root = self._path(directory)
+        with open(sumsfile, 'w') as f:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    if os.path.islink(path):
+                        continue
+                    digest = hashlib.new(csumtype)
+                    with open(path, 'rb') as source:
+                        digest.update(source.read())
+                    f.write('{}  ./{}\n'.format(digest.hexdigest(), os.path.relpath(path, root)))
+
+    def tar_in(self, tarfile_, directory, compress=None, **kwargs):
+        self._call()
+        # Path may be a FIFO, read it whole like libguestfs does
+        with open(tarfile_, 'rb') as f:
+            data = f.read()
+        _sleep('transfer_mb', len(data) / 1048576.0)
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as tar:
+            tar.extractall(self._path(directory))
+
+    def tar_out(self, directory, tarfile_, compress=None, excludes=None, **kwargs):
+        self._call()
+        mode = {None: 'w', 'gzip': 'w:gz', 'bzip2': 'w:bz2', 'xz': 'w:xz'}[compress]
+
+        def exclude(info):
+            if any(fnmatch.fnmatchcase(info.name, pattern) for pattern in excludes or []):
+                return None
+            return info
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode=mode) as tar:
+            tar.add(self._path(directory), arcname='.', filter=exclude)
+        _sleep('transfer_mb', len(data.getvalue()) / 1048576.0)
+        with open(tarfile_, 'wb') as f:
+            f.write(data.getvalue())
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Benchmarks of module operations and appliance lifecycle.
+
+By default operations run against 'fake_guestfs', a local stand-in for
+libguestfs with simulated latencies, no appliance, image or network is
+required. '--build-image' runs the same scenarios against a small image
+built locally with virt-make-fs using the installed libguestfs.
+
+Examples:
+  python benchmarks/run.py
+  python benchmarks/run.py --latency launch=2.5 --iterations 3
+  python benchmarks/run.py --save baseline.json
+  python benchmarks/run.py --compare baseline.json --tolerance 0.25
+  python benchmarks/run.py --build-image
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+
+class Context(object):
+    """Files and module parameters shared by scenarios."""
+
+    def __init__(self, args, workdir):
+        self.workdir = workdir
+        self.image = args.image
+        self.mounts = None
+        self.file_size = args.file_size
+        self.cache_dir = os.path.join(workdir, 'cache')
+        self.src = os.path.join(workdir, 'payload.bin')
+        with open(self.src, 'wb') as f:
+            f.write(os.urandom(args.file_size))
+        if not self.image:
+            self.image = os.path.join(workdir, 'fake.qcow2')
+            open(self.image, 'wb').close()
+
+    def params(self, **kwargs):
+        params = {
+            'image': self.image,
+            'automount': self.mounts is None,
+            'mounts': [dict(m) for m in self.mounts] if self.mounts else None,
+            'network': False,
+            'selinux_relabel': False,
+            'readonly': None,
+            'inspection_cache': False,
+            'cache_dir': self.cache_dir,
+            'session': None,
+            'profile': True,
+        }
+        params.update(kwargs)
+        return params
+
+
+def _run(ctx, operation, readonly=False, **params):
+    from plugins.module_utils.libguestfs import guest_module, run_operation
+    results, err = run_operation(guest_module(ctx.params(**params)), operation, readonly=readonly)
+    if err:
+        raise RuntimeError(results.get('msg'))
+    return results
+
+
+def scenario_launch(ctx):
+    from plugins.module_utils.libguestfs import guest, guest_module
+    g = guest(guest_module(ctx.params()))
+    g.bootstrap()
+    g.close()
+
+
+def scenario_command(ctx):
+    from plugins.module_utils.operations import execute
+    _run(ctx, execute, shell='true', command=None)
+
+
+def scenario_upload(ctx):
+    from plugins.module_utils.operations import upload
+    _run(ctx, upload, src=ctx.src, dest='/payload.bin', recursive=False)
+
+
+def scenario_download(ctx):
+    from plugins.module_utils.libguestfs import guest, guest_module
+    from plugins.module_utils.operations import download, upload
+    # Seed guest with the payload, fake guest filesystem lives as long as the handle
+    g = guest(guest_module(ctx.params(src=ctx.src, dest='/payload.bin', recursive=False)))
+    instance = g.bootstrap()
+    upload(instance, g.module)
+    g.module.params.update(src='/payload.bin', dest=os.path.join(ctx.workdir, 'downloaded.bin'))
+    with g.timer('operation'):
+        download(instance, g.module)
+    g.close()
+
+
+def scenario_package_list(ctx):
+    from plugins.module_utils.operations import packages
+    _run(ctx, packages, readonly=True, name=None, state=None, list='package1.*')
+
+
+def scenario_user(ctx):
+    from plugins.module_utils.operations import users
+    _run(ctx, users, name='bench', password='bench', state='present')
+
+
+def scenario_separate_5(ctx):
+    for dummy in range(5):
+        scenario_command(ctx)
+
+
+def scenario_batch_5(ctx):
+    from plugins.module_utils.operations import run_steps, step_params
+    steps = [step_params({'shell': 'true'}) for dummy in range(5)]
+    _run(ctx, lambda instance, module: run_steps(instance, module, steps))
+
+
+def scenario_inspection_cache(ctx):
+    from plugins.module_utils.operations import execute
+    _run(ctx, execute, shell='true', command=None, inspection_cache=True, readonly=True)
+
+
+SCENARIOS = [
+    ('launch', scenario_launch),
+    ('command', scenario_command),
+    ('upload', scenario_upload),
+    ('download', scenario_download),
+    ('package_list', scenario_package_list),
+    ('user', scenario_user),
+    ('separate_5', scenario_separate_5),
+    ('batch_5', scenario_batch_5),
+    ('inspection_cache', scenario_inspection_cache),
+]
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent))
+    return values[index]
+
+
+def run_scenarios(args, ctx, stats):
+    report = {}
+    selected = [s for s in SCENARIOS if not args.scenario or s[0] in args.scenario]
+    for name, scenario in selected:
+        durations = []
+        launches = []
+        for dummy in range(args.iterations):
+            before = stats()
+            start = time.time()
+            scenario(ctx)
+            durations.append(time.time() - start)
+            launches.append(stats() - before)
+        report[name] = {
+            'iterations': args.iterations,
+            'mean': sum(durations) / len(durations),
+            'p50': _percentile(durations, 0.5),
+            'p95': _percentile(durations, 0.95),
+            'launches': max(launches),
+        }
+    return report
+
+
+def print_report(report):
+    print('{:<20} {:>10} {:>10} {:>10} {:>9}'.format('scenario', 'mean ms', 'p50 ms', 'p95 ms', 'launches'))
+    for name, result in report.items():
+        print('{:<20} {:>10.1f} {:>10.1f} {:>10.1f} {:>9}'.format(
+            name, result['mean'] * 1000, result['p50'] * 1000, result['p95'] * 1000, result['launches']))
+
+
+def compare(report, baseline, tolerance):
+    """Returns list of regressions against a saved baseline."""
+
+    regressions = []
+    for name, result in report.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result['launches'] > expected['launches']:
+            regressions.append('{}: {} appliance launches, baseline {}'.format(
+                name, result['launches'], expected['launches']))
+        if result['mean'] > expected['mean'] * (1 + tolerance):
+            regressions.append('{}: mean {:.1f} ms, baseline {:.1f} ms'.format(
+                name, result['mean'] * 1000, expected['mean'] * 1000))
+    return regressions
+
+
+def build_image(workdir):
+    """Builds a small ext4 image with a single partition using virt-make-fs."""
+
+    content = os.path.join(workdir, 'content')
+    os.makedirs(os.path.join(content, 'etc'))
+    with open(os.path.join(content, 'etc', 'fstab'), 'w') as f:
+        f.write('/dev/sda1 / ext4 defaults 0 1\n')
+    image = os.path.join(workdir, 'bench.qcow2')
+    subprocess.check_call(['virt-make-fs', '--format=qcow2', '--type=ext4', '--partition',
+                           '--size=+64M', content, image])
+    return image
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--scenario', action='append', help='Run only the named scenario, may be repeated')
+    parser.add_argument('--latency', action='append', default=[],
+                        help='Override a fake latency in seconds, for example launch=2.5')
+    parser.add_argument('--applications', type=int, help='Number of applications reported by fake inspection')
+    parser.add_argument('--file-size', type=int, default=4 * 1048576, help='Size in bytes of transferred file')
+    parser.add_argument('--image', help='Run against this image using installed libguestfs, it is modified')
+    parser.add_argument('--build-image', action='store_true',
+                        help='Build a small image with virt-make-fs and run against it using installed libguestfs')
+    parser.add_argument('--json', action='store_true', help='Print report as JSON')
+    parser.add_argument('--save', help='Save report to file, to be used as baseline')
+    parser.add_argument('--compare', help='Compare against a saved baseline, exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown against baseline')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='guestfs-bench-')
+    real = bool(args.image or args.build_image)
+    try:
+        if real:
+            if args.build_image:
+                args.image = build_image(workdir)
+            import guestfs
+
+            # Appliance launches are counted by wrapping launch
+            launches = [0]
+            original_launch = guestfs.GuestFS.launch
+
+            def counted_launch(self):
+                launches[0] += 1
+                return original_launch(self)
+            guestfs.GuestFS.launch = counted_launch
+
+            def stats():
+                return launches[0]
+        else:
+            sys.path.insert(0, BENCHMARKS_DIR)
+            import fake_guestfs
+            sys.modules['guestfs'] = fake_guestfs
+            for override in args.latency:
+                name, value = override.split('=', 1)
+                fake_guestfs.LATENCIES[name] = float(value)
+            if args.applications is not None:
+                fake_guestfs.APPLICATIONS = args.applications
+
+            def stats():
+                return fake_guestfs.STATS['launches']
+
+        ctx = Context(args, workdir)
+        if args.build_image:
+            # Image has no operating system to inspect or manage
+            ctx.mounts = [{'/dev/sda1': '/'}]
+            args.scenario = args.scenario or [name for name, dummy in SCENARIOS
+                                              if name not in ['package_list', 'user', 'inspection_cache']]
+        report = run_scenarios(args, ctx, stats)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
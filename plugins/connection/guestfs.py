@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = """
+name: guestfs
+short_description: Run tasks against guest disk images using libguestfs
+description:
+  - Runs commands and transfers files inside a guest disk image through a libguestfs appliance
+  - The appliance is launched once by a session helper (see 'guestfs_session') and reused by every task of the host
+  - Changes to guest disk image are synced when session is stopped, either by 'guestfs_session' with 'state=stopped' or after 'idle_timeout'
+author:
+  - Vadim Khitrin (@vkhitrin)
+options:
+  remote_addr:
+    description: Path of guest disk image on Ansible controller
+    default: inventory_hostname
+    vars:
+      - name: inventory_hostname
+      - name: ansible_host
+  session:
+    description: Path to UNIX socket of the session serving guest disk image, derived from image path when not provided
+    vars:
+      - name: ansible_guestfs_session
+  idle_timeout:
+    description: Seconds without any task after which session is stopped, 0 disables timeout
+    type: int
+    default: 300
+    vars:
+      - name: ansible_guestfs_idle_timeout
+  automount:
+    description: Whether to perform auto mount of mountpoints inside guest disk image
+    type: bool
+    default: True
+    vars:
+      - name: ansible_guestfs_automount
+  mounts:
+    description: "List of mounts that will be attempted. Each element is a dictionary {'/path/to/device': '/path/to/mountpoint'}"
+    type: list
+    vars:
+      - name: ansible_guestfs_mounts
+  network:
+    description: Whether to enable network for appliance
+    type: bool
+    default: True
+    vars:
+      - name: ansible_guestfs_network
+  readonly:
+    description: Whether to add guest disk image read-only, changes made inside appliance are discarded
+    type: bool
+    default: False
+    vars:
+      - name: ansible_guestfs_readonly
+  inspection_cache:
+    description: Whether to cache guest disk image inspection results in 'cache_dir', cached results are used while image is unchanged
+    type: bool
+    default: False
+    vars:
+      - name: ansible_guestfs_inspection_cache
+  cache_dir:
+    description: Directory on Ansible controller used for caching
+    default: ~/.cache/ansible-libguestfs
+    vars:
+      - name: ansible_guestfs_cache_dir
+  appliance_memsize:
+    description: Memory of appliance in megabytes, libguestfs default is used when not provided
+    type: int
+    vars:
+      - name: ansible_guestfs_appliance_memsize
+  appliance_smp:
+    description: Number of virtual CPUs of appliance, libguestfs default is used when not provided
+    type: int
+    vars:
+      - name: ansible_guestfs_appliance_smp
+  backend:
+    description: libguestfs backend used to launch appliance, libguestfs default is used when not provided
+    vars:
+      - name: ansible_guestfs_backend
+  format:
+    description: Format of guest disk image (for example 'qcow2' or 'raw'), providing it skips format probing
+    vars:
+      - name: ansible_guestfs_format
+  cachemode:
+    description: Host cache mode of guest disk image, 'unsafe' ignores flush requests and should only be used for disposable images
+    choices:
+      - writeback
+      - unsafe
+    vars:
+      - name: ansible_guestfs_cachemode
+  selinux_relabel:
+    description: Whether to perform SELinux context relabeling when session is stopped
+    type: bool
+    default: False
+    vars:
+      - name: ansible_guestfs_selinux_relabel
+notes:
+  - Commands run as root inside the appliance, privilege escalation is not required
+  - stderr of commands is captured through a temporary file inside guest disk image
+requirements:
+  - "libguestfs"
+  - "libguestfs-devel"
+  - "python >= 2.7.5 || python >= 3.4"
+"""
+
+EXAMPLES = """
+# Inventory:
+#   [images]
+#   /tmp/rhel7-5.qcow2 ansible_connection=vkhitrin.libguestfs.guestfs ansible_guestfs_session=/tmp/rhel7-5.sock
+
+- hosts: images
+  gather_facts: False
+  tasks:
+    - name: Template a configuration file
+      ansible.builtin.template:
+        src: motd.j2
+        dest: /etc/motd
+
+    - name: Stop the session and sync changes to guest disk image
+      vkhitrin.libguestfs.guestfs_session:
+        image: "{{ inventory_hostname }}"
+        session: /tmp/rhel7-5.sock
+        state: stopped
+      delegate_to: localhost
+"""
+
+import hashlib
+import os
+import socket
+import tempfile
+import uuid
+
+from ansible.errors import AnsibleConnectionFailure, AnsibleError, AnsibleFileNotFound
+from ansible.module_utils.common.text.converters import to_bytes, to_native, to_text
+from ansible.module_utils.six.moves import shlex_quote
+from ansible.plugins.connection import ConnectionBase
+from ansible.utils.display import Display
+
+from ansible_collections.vkhitrin.libguestfs.plugins.module_utils.libguestfs import GuestfsError, guest, guest_module
+from ansible_collections.vkhitrin.libguestfs.plugins.module_utils.session import session_alive, start_session
+
+display = Display()
+
+
+class Connection(ConnectionBase):
+    ''' libguestfs based connection '''
+
+    transport = 'vkhitrin.libguestfs.guestfs'
+    has_pipelining = False
+    has_tty = False
+    default_user = 'root'
+
+    def __init__(self, play_context, new_stdin, *args, **kwargs):
+        super(Connection, self).__init__(play_context, new_stdin, *args, **kwargs)
+        self._guest = None
+        self._handle = None
+
+    def _session_path(self, image):
+        session = self.get_option('session')
+        if session:
+            return os.path.expanduser(session)
+        image_id = hashlib.sha1(to_bytes(os.path.realpath(image))).hexdigest()[:16]
+        return os.path.join(tempfile.gettempdir(), 'ansible-guestfs-{}.sock'.format(image_id))
+
+    def _connect(self):
+        if self._connected:
+            return self
+
+        image = os.path.expanduser(self.get_option('remote_addr'))
+        session = self._session_path(image)
+        params = {
+            'image': image,
+            'automount': self.get_option('automount'),
+            'mounts': [dict(m) for m in self.get_option('mounts') or []],
+            'network': self.get_option('network'),
+            'selinux_relabel': self.get_option('selinux_relabel'),
+            'readonly': self.get_option('readonly'),
+            'inspection_cache': self.get_option('inspection_cache'),
+            'cache_dir': self.get_option('cache_dir'),
+            'appliance_memsize': self.get_option('appliance_memsize'),
+            'appliance_smp': self.get_option('appliance_smp'),
+            'backend': self.get_option('backend'),
+            'format': self.get_option('format'),
+            'cachemode': self.get_option('cachemode'),
+            'session': None,
+        }
+
+        if not session_alive(session):
+            display.vvv(u'STARTING GUESTFS SESSION {} FOR {}'.format(session, image), host=image)
+            err = start_session(guest(guest_module(dict(params))), session, self.get_option('idle_timeout'))
+            if err:
+                raise AnsibleConnectionFailure('Failed to start session for {}: {}'.format(image, err))
+
+        display.vvv(u'ATTACHING TO GUESTFS SESSION {}'.format(session), host=image)
+        params['session'] = session
+        self._guest = guest(guest_module(params))
+        try:
+            self._handle = self._guest.bootstrap()
+            self._handle.mount_paths('/')
+            # Modules run through the connection may change any path,
+            # the whole filesystem is relabeled when the session stops
+            self._handle.mark_touched('/')
+        except (GuestfsError, RuntimeError, socket.error) as e:
+            raise AnsibleConnectionFailure(to_native(e))
+        self._connected = True
+        return self
+
+    def exec_command(self, cmd, in_data=None, sudoable=False):
+        super(Connection, self).exec_command(cmd, in_data=in_data, sudoable=sudoable)
+
+        display.vvv(u'EXEC {}'.format(cmd), host=self.get_option('remote_addr'))
+        # libguestfs 'sh' raises on non-zero exit codes and drops stderr,
+        # capture both through files and report the exit code on stdout
+        output = '/tmp/.ansible-guestfs-{}'.format(uuid.uuid4().hex)
+        redirect = ''
+        if in_data:
+            self._handle.write(output + '.in', to_bytes(in_data))
+            redirect = ' < {}'.format(shlex_quote(output + '.in'))
+        script = 'HOME=/root; export HOME; cd /; ( {cmd} ){redirect} > {out}.out 2> {out}.err; echo $?'.format(
+            cmd=to_text(cmd), redirect=redirect, out=output)
+        try:
+            rc = int(self._handle.sh(script).strip().splitlines()[-1])
+            stdout = self._handle.read_file(output + '.out')
+            stderr = self._handle.read_file(output + '.err')
+            self._handle.rm_f(output + '.out')
+            self._handle.rm_f(output + '.err')
+            self._handle.rm_f(output + '.in')
+        except (RuntimeError, ValueError, IndexError, socket.error) as e:
+            raise AnsibleConnectionFailure('Failed to execute command inside guest disk image: {}'.format(to_native(e)))
+        return rc, to_bytes(stdout), to_bytes(stderr)
+
+    def put_file(self, in_path, out_path):
+        super(Connection, self).put_file(in_path, out_path)
+
+        display.vvv(u'PUT {} TO {}'.format(in_path, out_path), host=self.get_option('remote_addr'))
+        if not os.path.exists(to_bytes(in_path, errors='surrogate_or_strict')):
+            raise AnsibleFileNotFound('file or module does not exist: {}'.format(in_path))
+        try:
+            self._handle.upload(in_path, out_path)
+        except (RuntimeError, socket.error) as e:
+            raise AnsibleError('Failed to transfer file {} to {}: {}'.format(in_path, out_path, to_native(e)))
+
+    def fetch_file(self, in_path, out_path):
+        super(Connection, self).fetch_file(in_path, out_path)
+
+        display.vvv(u'FETCH {} TO {}'.format(in_path, out_path), host=self.get_option('remote_addr'))
+        try:
+            self._handle.download(in_path, out_path)
+        except (RuntimeError, socket.error) as e:
+            raise AnsibleError('Failed to fetch file {} to {}: {}'.format(in_path, out_path, to_native(e)))
+
+    def close(self):
+        # Only detach, the session keeps the appliance for following tasks
+        if self._guest:
+            self._guest.close()
+        self._guest = None
+        self._handle = None
+        self._connected = False
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+
+class ModuleDocFragment(object):
+
+    # Options shared by all modules launching an appliance
+    DOCUMENTATION = r'''
+options:
+  image:
+    required: True
+    description:
+      - Image path on filesystem
+      - May be a glob pattern or a list of paths and patterns, the operation then runs against each image in parallel with its own appliance and results of each image are returned as 'images'
+  max_workers:
+    required: False
+    description: Maximum number of images handled in parallel when 'image' matches several images, defaults to the number of CPUs on host
+  automount:
+    required: False
+    description: Whether to perform auto mount of mountpoints inside guest disk image
+    default: True
+  mounts:
+    required: False
+    description: "List of mounts that will be attempted. Each element is a dictionary {'/path/to/device': '/path/to/mountpoint'}"
+  lazy_mount:
+    required: False
+    description:
+      - Whether to defer mounting filesystems until the module touches a path on them, only filesystems whose mountpoints hold or are nested under touched paths are mounted
+      - With 'automount', every filesystem found by inspection (not only the root device) is a candidate
+      - Commands, package and user management touch the whole filesystem and mount everything
+    default: False
+  network:
+    required: False
+    description: Whether to enable network for appliance
+    default: True
+  session:
+    required: False
+    description: Path to UNIX socket of a session started by 'guestfs_session', when provided the session's launched appliance is used instead of launching a new one
+  readonly:
+    required: False
+    description: Whether to add guest disk image read-only, changes made inside appliance are discarded
+  inspection_cache:
+    required: False
+    description: Whether to cache guest disk image inspection results in 'cache_dir', cached results are used while image is unchanged
+    default: False
+  cache_dir:
+    required: False
+    description: Directory on filesystem used for caching
+    default: ~/.cache/ansible-libguestfs
+  selinux_relabel:
+    required: False
+    description:
+      - Whether to perform SELinux context relabeling of paths changed by the module
+      - Paths changed by commands and package managers are found with 'find' inside guest disk image, the whole filesystem is relabeled when they cannot be determined or there are too many of them
+      - When the SELinux policy is not available inside guest disk image, relabeling is scheduled for next boot
+    default: False
+  selinux_relabel_full:
+    required: False
+    description: Whether to relabel the whole filesystem instead of only changed paths when 'selinux_relabel' is enabled
+    default: False
+  appliance_memsize:
+    required: False
+    description: Memory of appliance in megabytes, libguestfs default is used when not provided
+  appliance_smp:
+    required: False
+    description: Number of virtual CPUs of appliance, libguestfs default is used when not provided
+  backend:
+    required: False
+    description: libguestfs backend used to launch appliance (for example 'direct' or 'libvirt'), libguestfs default is used when not provided
+  format:
+    required: False
+    description: Format of guest disk image (for example 'qcow2' or 'raw'), providing it skips format probing
+  cachemode:
+    required: False
+    description: Host cache mode of guest disk image, 'unsafe' ignores flush requests and should only be used for disposable images
+    choices:
+    - writeback
+    - unsafe
+  overlay:
+    required: False
+    description:
+      - Whether to write changes to a temporary qcow2 overlay backed by guest disk image instead of the image itself
+      - When the module succeeds the overlay is committed into the image with 'qemu-img commit' (or renamed to 'overlay_dest'), when it fails the overlay is discarded and the image is left untouched
+      - Ignored for read-only handles
+    default: False
+  overlay_dest:
+    required: False
+    description:
+      - Path the overlay is renamed to when the module succeeds, guest disk image itself is not modified
+      - The result is a qcow2 image backed by guest disk image (referenced by absolute path), which must be kept
+      - "'{image}' in the path is replaced by the image file name, it is required when 'image' matches several images, which would otherwise share one destination"
+  build_cache:
+    required: False
+    description:
+      - Whether to cache the overlay built by the module in 'cache_dir' and reuse it instead of launching the appliance when the module runs again with identical inputs
+      - Inputs are the content identity of guest disk image (the building layer for images produced by a cached build, otherwise path, inode, size and modification time), module parameters and digests of uploaded host files
+      - Requires 'overlay_dest', the built layer is copied there and guest disk image itself is never modified
+      - "Several images require '{image}' in 'overlay_dest', each image builds and caches its own layer"
+      - Can not be used with 'session'
+      - Ignored by read-only operations and by modules writing to host (copy out, batches with download steps)
+    default: False
+  image_lock:
+    required: False
+    description:
+      - Whether to take an advisory lock (flock) on guest disk image while the appliance uses it, exclusive for writers and shared for read-only handles
+      - Time spent waiting for the lock is returned as 'lock_wait' (in seconds)
+    default: True
+  lock_timeout:
+    required: False
+    description: Seconds to wait for the image lock held by other tasks before failing, waits indefinitely when not provided
+  profile:
+    required: False
+    description: Whether to return durations (in seconds) of image lock wait, appliance launch, inspection, mount, operation, SELinux relabel, umount/sync, shutdown and overlay commit as 'timings'
+    default: False
+'''
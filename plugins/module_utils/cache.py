@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+DEFAULT_CACHE_DIR = '~/.cache/ansible-libguestfs'
+
+
+def image_identity(image):
+    # Cheap identity of an image file, changes whenever the file is written to
+    stat = os.stat(image)
+    mtime = getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1000000000))
+    return [os.path.realpath(image), stat.st_ino, stat.st_size, mtime]
+
+
+def cache_file(cache_dir, kind, key):
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR), kind, digest + '.json')
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    # Write to a temporary file and rename it into place, concurrent
+    # readers never observe a partially written entry
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        # Caching is best effort, never fail an operation because of it
+        return False
+    return True
+
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        return False
+    return True
+
+
+def load_inspection(cache_dir, image):
+    """Returns cached inspection of image, None if missing or image changed since."""
+
+    entry = read_json(cache_file(cache_dir, 'inspection', os.path.realpath(image)))
+    if not entry or entry.get('identity') != image_identity(image):
+        return None
+    return entry
+
+
+def store_inspection(cache_dir, image, identity, roots, checksums):
+    return write_json(cache_file(cache_dir, 'inspection', os.path.realpath(image)), {
+        'identity': identity,
+        'roots': roots,
+        'checksums': checksums,
+    })
+
+
+def drop_inspection(cache_dir, image):
+    return remove_file(cache_file(cache_dir, 'inspection', os.path.realpath(image)))
+
+
+def layer_files(cache_dir, key):
+    # Overlay of a cached build layer and the results of the operation which built it
+    results = cache_file(cache_dir, 'layers', key)
+    return results[:-len('.json')] + '.qcow2', results
+
+
+def copy_file(src, dest):
+    # Copy to a temporary file and rename it into place
+    directory = os.path.dirname(os.path.abspath(dest))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.rename(tmp_path, dest)
+    except (IOError, OSError):
+        remove_file(tmp_path)
+        raise
+
+
+def content_identity(cache_dir, image):
+    """Returns identity of image content, the building layer for images produced by a cached build."""
+
+    entry = read_json(cache_file(cache_dir, 'outputs', os.path.realpath(image)))
+    if entry and entry.get('identity') == image_identity(image):
+        return ['layer', os.path.realpath(image), entry['layer']]
+    return image_identity(image)
+
+
+def output_layer(cache_dir, path):
+    """Returns key of the layer at path, None if it was not produced by a cached build or changed since."""
+
+    entry = read_json(cache_file(cache_dir, 'outputs', os.path.realpath(path)))
+    if entry and os.path.exists(path) and entry.get('identity') == image_identity(path):
+        return entry['layer']
+    return None
+
+
+def record_output(cache_dir, path, key):
+    return write_json(cache_file(cache_dir, 'outputs', os.path.realpath(path)), {
+        'identity': image_identity(path),
+        'layer': key,
+    })
+
+
+def load_layer(cache_dir, key):
+    """Returns results of a cached layer, None if missing."""
+
+    overlay, results = layer_files(cache_dir, key)
+    if not os.path.exists(overlay):
+        return None
+    return read_json(results)
+
+
+def store_layer(cache_dir, key, overlay, results):
+    layer, results_path = layer_files(cache_dir, key)
+    try:
+        copy_file(overlay, layer)
+    except (IOError, OSError):
+        return False
+    return write_json(results_path, results)
+
+
+@contextmanager
+def locked(path, shared=False):
+    """Holds an advisory lock on path (created if missing) of a cache shared by concurrent runs."""
+
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # Created by a concurrent run
+        if not os.path.isdir(directory):
+            raise
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+
+def load_inventory(path, image):
+    """Returns packages of an inventory file, None if missing or image changed since."""
+
+    entry = read_json(path)
+    if not entry or entry.get('image') != os.path.realpath(image) or entry.get('identity') != image_identity(image):
+        return None
+    return entry['packages']
+
+
+def store_inventory(path, image, packages):
+    return write_json(path, {
+        'image': os.path.realpath(image),
+        'identity': image_identity(image),
+        'packages': packages,
+    })
@@ -7,41 +7,390 @@
 from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+import multiprocessing
 import os
+import posixpath
 import re
+import socket
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
 try:
     import guestfs
     HAS_GUESTFS = True
 except ImportError:
     HAS_GUESTFS = False
 
+from .cache import (DEFAULT_CACHE_DIR, content_identity, copy_file, drop_inspection, image_identity, layer_files,
+                    load_inspection, load_layer, output_layer, record_output, store_inspection, store_layer)
+from .session import SessionClient
+from .transfer import source_digest
+
+# Monotonic clock is not available on python 2
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class GuestfsError(Exception):
+    pass
+
+
+class guest_module():
+    # Minimal stand-in for AnsibleModule, allows driving 'guest' outside of
+    # a module invocation (session helpers, connection plugin)
+    def __init__(self, params):
+        self.params = params
+
+    def fail_json(self, **kwargs):
+        raise GuestfsError(kwargs.get('msg'))
+
+    def md5(self, path):
+        # Same digest as AnsibleModule.md5
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+def guest_argument_spec(**kwargs):
+    # Parameters consumed by guest, shared by all modules
+    argument_spec = dict(
+        image=dict(required=True, type='raw'),
+        max_workers=dict(required=False, type='int'),
+        automount=dict(required=False, type='bool', default=True),
+        mounts=dict(required=False,  type='list', elements='dict'),
+        lazy_mount=dict(required=False, type='bool', default=False),
+        network=dict(required=False, type='bool', default=True),
+        selinux_relabel=dict(required=False, type='bool', default=False),
+        selinux_relabel_full=dict(required=False, type='bool', default=False),
+        readonly=dict(required=False, type='bool'),
+        inspection_cache=dict(required=False, type='bool', default=False),
+        cache_dir=dict(required=False, type='path'),
+        session=dict(required=False, type='path'),
+        appliance_memsize=dict(required=False, type='int'),
+        appliance_smp=dict(required=False, type='int'),
+        backend=dict(required=False, type='str'),
+        format=dict(required=False, type='str'),
+        cachemode=dict(required=False, choices=['writeback', 'unsafe']),
+        profile=dict(required=False, type='bool', default=False),
+        overlay=dict(required=False, type='bool', default=False),
+        overlay_dest=dict(required=False, type='path'),
+        build_cache=dict(required=False, type='bool', default=False),
+        image_lock=dict(required=False, type='bool', default=True),
+        lock_timeout=dict(required=False, type='float'),
+    )
+    argument_spec.update(kwargs)
+    return argument_spec
+
+
+# Seconds between attempts to take a contended image lock
+LOCK_POLL_INTERVAL = 0.1
+
+# Targeted relabel falls back to relabeling the whole filesystem above this
+MAX_RELABEL_PATHS = 500
+
+# Files inspection is derived from: mountpoints from fstab, distribution,
+# release and package management from release files and package managers.
+# A write changing any of them invalidates the cached inspection of an image
+INSPECTED_FILES = ['/etc/fstab', '/etc/os-release', '/usr/lib/os-release', '/etc/lsb-release', '/etc/redhat-release',
+                   '/etc/debian_version', '/etc/SuSE-release']
+INSPECTED_PATHS = ['/usr/bin/dnf', '/usr/bin/yum', '/usr/bin/apt-get', '/usr/bin/zypper']
+
+# Bytes of the scratch drive holding package downloads, it is sparse and
+# only takes the space actually written, in a temporary file removed on close
+SCRATCH_DRIVE_SIZE = 32 * 1024 ** 3
+
+
+def covering_paths(paths):
+    """Returns sorted absolute paths without those nested under another path."""
+
+    covering = []
+    for path in sorted(set(posixpath.normpath(path) for path in paths if path), key=lambda path: path.split('/')):
+        if covering and (path == covering[-1] or path.startswith(covering[-1].rstrip('/') + '/')):
+            continue
+        covering.append(path)
+    return covering
+
+
+def package_option(params, option):
+    # Whether a package option is set by the module, or by one of its batch steps
+    if params.get(option):
+        return True
+    for step in params.get('steps') or []:
+        if isinstance(step, dict) and isinstance(step.get('package'), dict) and step['package'].get(option):
+            return True
+    return False
+
+
+def path_within(path, directory):
+    # Whether path is directory itself or nested under it
+    path = posixpath.normpath(path)
+    directory = posixpath.normpath(directory)
+    return directory == '/' or path == directory or path.startswith(directory + '/')
+
 
 class guest():
+    # Once bootstrapped, guest is used as the handle by module operations,
+    # libguestfs calls which are not implemented here go to the handle
     def __init__(self, module):
-        self.mount = False
+        self.mounted = False
         self.automount = False
-        self.mounts = False
+        self.mount_requests = False
+        self.lazy_mount = False
+        self.pending_mounts = []
+        self.mountpoints = []
         self.module = module
         self.handle = None
         self.network = False
         self.image = None
         self.se_relabel = False
+        self.session = None
+        self.readonly = False
+        self.inspection = None
+        self.inspected = False
+        self.inspection_cache = False
+        self.cache_dir = DEFAULT_CACHE_DIR
+        self.identity = None
+        self.checksums = None
+        self.timings = {}
+        self.progress_listeners = []
+        self.touched = set()
+        self.lock = None
+        self.overlay = None
+        self.scratch = None
+        self.done = set()
         if HAS_GUESTFS is False:
             results = {}
             results['msg'] = "libguestfs Python bindings are required for this module"
             self.module.fail_json(**results)
 
+    def __getattr__(self, name):
+        handle = self.__dict__.get('handle')
+        if handle is None:
+            raise AttributeError(name)
+        # Inspection APIs require 'inspect_os' to run in the handle,
+        # which is skipped when inspection was loaded from cache
+        if name.startswith('inspect_') and not self.inspected:
+            self.inspect_roots()
+        return getattr(handle, name)
+
+    def inspect_roots(self):
+        roots = {}
+        for root in self.handle.inspect_os():
+            roots[root] = {
+                'mountpoints': self.handle.inspect_get_mountpoints(root),
+                'type': self.handle.inspect_get_type(root),
+                'distro': self.handle.inspect_get_distro(root),
+                'package_management': self.handle.inspect_get_package_management(root),
+                'major_version': self.handle.inspect_get_major_version(root),
+                'minor_version': self.handle.inspect_get_minor_version(root),
+                'arch': self.handle.inspect_get_arch(root),
+            }
+        self.inspected = True
+        return roots
+
+    def inspect_os(self):
+        return sorted(self.inspection)
+
+    def inspect_get_mountpoints(self, root):
+        return self._inspected(root, 'mountpoints')
+
+    def inspect_get_type(self, root):
+        return self._inspected(root, 'type')
+
+    def inspect_get_distro(self, root):
+        return self._inspected(root, 'distro')
+
+    def inspect_get_package_management(self, root):
+        return self._inspected(root, 'package_management')
+
+    def inspect_get_major_version(self, root):
+        return self._inspected(root, 'major_version')
+
+    def inspect_get_minor_version(self, root):
+        return self._inspected(root, 'minor_version')
+
+    def inspect_get_arch(self, root):
+        return self._inspected(root, 'arch')
+
+    def _inspected(self, root, key):
+        # Entries cached by older versions may lack some keys
+        if root in self.inspection and key in self.inspection[root]:
+            return self.inspection[root][key]
+        if not self.inspected:
+            self.inspect_roots()
+        return getattr(self.handle, 'inspect_get_' + key)(root)
+
+    def inspection_checksums(self):
+        # Checksums of files inspection is derived from, and whether package
+        # managers exist, compared before carrying cached inspection forward
+        self.mount_paths(*(INSPECTED_FILES + INSPECTED_PATHS))
+        checksums = {}
+        for path in INSPECTED_FILES:
+            if self.handle.is_file(path):
+                checksums[path] = self.handle.checksum('md5', path)
+        for path in INSPECTED_PATHS:
+            checksums[path] = self.handle.exists(path)
+        return checksums
+
+    def tune_appliance(self):
+        # Must be called before the appliance is launched
+        ansible_module_params = self.module.params
+        if ansible_module_params.get('backend'):
+            self.handle.set_backend(ansible_module_params.get('backend'))
+        if ansible_module_params.get('appliance_memsize'):
+            self.handle.set_memsize(ansible_module_params.get('appliance_memsize'))
+        if ansible_module_params.get('appliance_smp'):
+            self.handle.set_smp(ansible_module_params.get('appliance_smp'))
+
     def mount_device(self, device, mountpoint):
-        return self.handle.mount(device, mountpoint)
+        results = {}
+        try:
+            if self.readonly:
+                self.handle.mount_ro(device, mountpoint)
+            else:
+                self.handle.mount(device, mountpoint)
+        except RuntimeError as e:
+            results['msg'] = ("Couldn't mount device inside guest "
+                              "disk image, python exception: {}"
+                              .format(str(e)))
+            self.module.fail_json(**results)
+        self.mountpoints.append(mountpoint)
+
+    def progress_event(self, event, event_handle, buf, array):
+        # Array holds procedure, serial, position and total of the running call
+        for listener in list(self.progress_listeners):
+            listener(array[2], array[3])
+
+    def lock_image(self, shared=False):
+        # Advisory lock serializing writers of the image, read-only handles
+        # share it. qemu locks byte ranges of the image with OFD locks,
+        # which do not conflict with flock
+        results = {}
+        timeout = self.module.params.get('lock_timeout')
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        start = _clock()
+        self.lock = open(self.image, 'rb')
+        while True:
+            try:
+                fcntl.flock(self.lock, operation | fcntl.LOCK_NB)
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    self.unlock_image()
+                    results['msg'] = 'Could not lock image {}, python exception: {}'.format(self.image, str(e))
+                    self.module.fail_json(**results)
+            if timeout is not None and _clock() - start >= timeout:
+                self.unlock_image()
+                results['msg'] = 'Timed out after {} seconds waiting for lock on image {}'.format(timeout, self.image)
+                self.module.fail_json(**results)
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def unlock_image(self):
+        # Closing the file releases the lock
+        if self.lock:
+            self.lock.close()
+            self.lock = None
 
-    def bootstrap(self):
+    def create_overlay(self):
+        # Appliance writes go to a qcow2 overlay backed by the image, created
+        # next to its final location so it can be renamed into place
+        results = {}
+        target = self.module.params.get('overlay_dest') or self.image
+        fd, self.overlay = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)),
+                                            prefix='.{}.'.format(os.path.basename(target)), suffix='.overlay')
+        os.close(fd)
+        try:
+            backing_format = self.module.params.get('format') or self.handle.disk_format(self.image)
+            self.handle.disk_create(self.overlay, 'qcow2', -1, backingfile=os.path.abspath(self.image),
+                                    backingformat=backing_format)
+        except RuntimeError as e:
+            self.discard_overlay()
+            results['msg'] = 'Could not create overlay of image {}, python exception: {}'.format(self.image, str(e))
+            self.module.fail_json(**results)
+        return self.overlay
+
+    def abort(self):
+        # Releases the appliance, overlay and lock of a failed bootstrap
+        if self.handle:
+            for call in (self.handle.shutdown, self.handle.close):
+                try:
+                    call()
+                except Exception:
+                    pass
+            self.handle = None
+        self.discard_overlay()
+        self.unlock_image()
+
+    def discard_overlay(self):
+        if self.overlay:
+            os.unlink(self.overlay)
+            self.overlay = None
+
+    def finish_overlay(self, failed):
+        """Discards overlay when operation failed, otherwise commits it into the
+        image or renames it to 'overlay_dest'. Returns whether image was written."""
+
+        results = {}
+        if failed:
+            self.discard_overlay()
+            return False
+        overlay_dest = self.module.params.get('overlay_dest')
+        try:
+            if overlay_dest:
+                os.rename(self.overlay, overlay_dest)
+            else:
+                subprocess.check_output(['qemu-img', 'commit', '-q', self.overlay], stderr=subprocess.STDOUT)
+                os.unlink(self.overlay)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Overlay holds the only copy of the changes, keep it
+            results['msg'] = 'Could not {} overlay {}, changes are kept in it: {}'.format(
+                'rename' if overlay_dest else 'commit', self.overlay, getattr(e, 'output', None) or str(e))
+            self.overlay = None
+            self.module.fail_json(**results)
+        self.overlay = None
+        return not overlay_dest
+
+    @contextmanager
+    def timer(self, phase):
+        # Accumulates wall time of a phase, reported when 'profile' is enabled
+        start = _clock()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0) + _clock() - start
+
+    def profile(self):
+        return dict((phase, round(duration, 3)) for phase, duration in self.timings.items())
+
+    def bootstrap(self, readonly=False):
+        # 'readonly' is the module's default for its operation,
+        # it is overridden by an explicit 'readonly' module parameter
         results = {}
         ansible_module_params = self.module.params
         self.image = ansible_module_params.get('image')
         self.automount = ansible_module_params.get('automount')
-        self.mounts = ansible_module_params.get('mounts')
-        self.network = ansible_module_params.get('network')
-        if self.mounts and self.automount:
+        self.mount_requests = ansible_module_params.get('mounts')
+        self.lazy_mount = ansible_module_params.get('lazy_mount')
+        # Packages installed from a local repository are installed offline
+        self.network = ansible_module_params.get('network') and not package_option(ansible_module_params, 'local_repo')
+        self.session = ansible_module_params.get('session')
+        self.se_relabel = ansible_module_params.get('selinux_relabel')
+        self.inspection_cache = ansible_module_params.get('inspection_cache')
+        self.cache_dir = ansible_module_params.get('cache_dir') or DEFAULT_CACHE_DIR
+        if ansible_module_params.get('readonly') is not None:
+            readonly = ansible_module_params.get('readonly')
+        self.readonly = readonly
+        if self.session:
+            with self.timer('attach'):
+                return self.attach()
+        if self.mount_requests and self.automount:
             results['msg'] = ('Automount (enabled by default) and manual '
                               ' mounts were requested by module, please '
                               'disable automount if providing manual '
@@ -50,16 +399,68 @@ class guest():
         if os.path.exists(self.image) is False:
             results['msg'] = 'Could not find image'
             self.module.fail_json(**results)
-        self.handle = guestfs.GuestFS(python_return_dict=True)
-        self.handle.add_drive_opts(self.image, readonly=0)
-        if self.network:
-            self.handle.set_network(True)
+        # Writes to an overlay renamed to 'overlay_dest' leave the image untouched
+        overlay = ansible_module_params.get('overlay') and not self.readonly
+        if ansible_module_params.get('image_lock', True):
+            with self.timer('lock_wait'):
+                self.lock_image(shared=self.readonly or bool(overlay and ansible_module_params.get('overlay_dest')))
         try:
-            self.handle.launch()
-        except Exception as e:
-            results['msg'] = 'Could not mount guest disk image, python exception: {}'.format(str(e))
-            self.module.fail_json(**results)
-        roots = self.handle.inspect_os()
+            cached = None
+            if self.inspection_cache:
+                self.identity = image_identity(self.image)
+                cached = load_inspection(self.cache_dir, self.image)
+            with self.timer('launch'):
+                self.handle = guestfs.GuestFS(python_return_dict=True)
+                self.tune_appliance()
+                if ansible_module_params.get('progress_file'):
+                    self.handle.set_event_callback(self.progress_event, guestfs.EVENT_PROGRESS)
+                # Read-only drives are opened by qemu with a shared image lock, writes
+                # are kept in a temporary overlay which is discarded on close
+                drive_opts = {'readonly': 1 if self.readonly else 0}
+                drive = self.image
+                if overlay:
+                    drive = self.create_overlay()
+                    drive_opts['format'] = 'qcow2'
+                elif ansible_module_params.get('format'):
+                    drive_opts['format'] = ansible_module_params.get('format')
+                if ansible_module_params.get('cachemode'):
+                    drive_opts['cachemode'] = ansible_module_params.get('cachemode')
+                self.handle.add_drive_opts(drive, **drive_opts)
+                # Package downloads are kept on a scratch drive instead of the guest disk image
+                scratch = not self.readonly and package_option(ansible_module_params, 'download_cache')
+                if scratch:
+                    self.handle.add_drive_scratch(SCRATCH_DRIVE_SIZE)
+                if self.network:
+                    self.handle.set_network(True)
+                try:
+                    self.handle.launch()
+                except Exception as e:
+                    results['msg'] = 'Could not mount guest disk image, python exception: {}'.format(str(e))
+                    self.module.fail_json(**results)
+                if scratch:
+                    # Drives are listed in the order they were added
+                    self.scratch = self.handle.list_devices()[-1]
+            with self.timer('inspect'):
+                if cached:
+                    self.inspection = cached['roots']
+                    self.checksums = cached.get('checksums')
+                else:
+                    self.inspection = self.inspect_roots()
+            with self.timer('mount'):
+                self.mount_filesystems()
+            if self.inspection_cache and not cached:
+                self.checksums = self.inspection_checksums()
+                store_inspection(self.cache_dir, self.image, self.identity, self.inspection, self.checksums)
+        except BaseException:
+            # Failed after taking the lock, nothing may be left behind
+            self.abort()
+            raise
+        return self
+
+    def mount_filesystems(self):
+        results = {}
+        roots = self.inspect_os()
+        mounts = []
         if self.automount:
             if len(roots) == 0:
                 results['msg'] = ('Automount failed, no devices were found in'
@@ -67,64 +468,346 @@ class guest():
                                   'manual mount')
                 self.module.fail_json(**results)
             for root in roots:
-                mps = self.handle.inspect_get_mountpoints(root)
+                mps = self.inspect_get_mountpoints(root)
+                if self.lazy_mount:
+                    # Every filesystem of the guest is a candidate,
+                    # only those covering touched paths get mounted
+                    mounts.extend((mountpoint, device) for mountpoint, device in mps.items())
+                    continue
                 # Filter the mountpoint mapped to root device,
                 # do not attempt to mount partitions
                 filtered_mounts = list(filter(lambda m: mps[m] == root, mps))
                 if not filtered_mounts:
                     results['msg'] = 'Failed to detect associated mountpoint for device {}.'.format(str(root))
                     self.module.fail_json(**results)
-                try:
-                    self.mount_device(root, filtered_mounts[0])
-                except RuntimeError as e:
-                    results['msg'] = ("Couldn't mount device inside guest disk"
-                                      "'image, python exception: {}"
-                                      .format(str(e)))
-                    self.module.fail_json(**results)
+                mounts.append((filtered_mounts[0], root))
         else:
-            if not self.mounts:
+            if not self.mount_requests:
                 results['msg'] = "Automount is disabled and no mountpoints were provided to module"
                 self.module.fail_json(**results)
-            for mount_request in self.mounts:
+            for mount_request in self.mount_requests:
                 if len(mount_request.keys()) > 1:
                     results['msg'] = "Dictionary '{}' is expected to have a single key".format(mount_request)
                     self.module.fail_json(**results)
-                device, mountpoint = mount_request.popitem()
-                try:
+                device, mountpoint = list(mount_request.items())[0]
+                mounts.append((mountpoint, device))
+        if self.lazy_mount:
+            self.pending_mounts = mounts
+        else:
+            for mountpoint, device in mounts:
+                self.mount_device(device, mountpoint)
+        self.mounted = True
+
+    def mount_paths(self, *paths):
+        # Lazy mounting, mounts pending filesystems holding paths or nested
+        # under them, parent mountpoints first. '/' mounts everything.
+        pending = sorted(self.pending_mounts, key=lambda mount: mount[0].rstrip('/').count('/'))
+        for mountpoint, device in pending:
+            if any(path_within(path, mountpoint) or path_within(mountpoint, path) for path in paths):
+                with self.timer('mount'):
                     self.mount_device(device, mountpoint)
-                except RuntimeError as e:
-                    results['msg'] = ("Couldn't mount device inside guest "
-                                      "disk image, python exception: {}"
-                                      .format(str(e)))
-                    self.module.fail_json(**results)
-        self.mount = True
+                self.pending_mounts.remove((mountpoint, device))
+
+    def attach(self):
+        # Reuse a handle that was launched and mounted by 'guestfs_session'
+        results = {}
+        try:
+            self.handle = SessionClient(self.session)
+            info = self.handle.call('__info__')
+        except (socket.error, RuntimeError, ValueError) as e:
+            results['msg'] = 'Could not attach to session {}, python exception: {}'.format(self.session, str(e))
+            self.module.fail_json(**results)
+        if os.path.realpath(info['image']) != os.path.realpath(self.image):
+            self.handle.close()
+            results['msg'] = 'Session {} serves image {}, not {}'.format(self.session, info['image'], self.image)
+            self.module.fail_json(**results)
+        self.mounted = True
         return self.handle
 
-    def close(self):
+    def scratch_drive(self):
+        # Device of the scratch drive added for package downloads, None without one
+        return self.scratch
+
+    def once(self, name):
+        # Whether a step done once per handle (such as refreshing package
+        # lists) was not done yet, later calls return False
+        if name in self.done:
+            return False
+        self.done.add(name)
+        return True
+
+    def mark_touched(self, *paths):
+        # Paths in guest changed by operations, relabeled on close instead
+        # of the whole filesystem, '/' when changes are unknown
+        self.touched.update(paths)
+
+    def relabel_paths(self):
+        """Returns paths to relabel, ['/'] when the whole filesystem is relabeled."""
+
+        if self.module.params.get('selinux_relabel_full') or '/' in self.touched:
+            return ['/']
+        paths = covering_paths(self.touched)
+        if len(paths) > MAX_RELABEL_PATHS:
+            paths = covering_paths(posixpath.dirname(path) for path in paths)
+        if len(paths) > MAX_RELABEL_PATHS:
+            return ['/']
+        return paths
+
+    def relabel(self):
+        # Relabel SELinux contexts
+        if not self.handle.is_file('/etc/selinux/config'):
+            return
+        selinux_spec_file = None
+        for line in self.handle.read_lines('/etc/selinux/config'):
+            match = re.match(r'\s*SELINUXTYPE=(?P<policy>\S+)', line)
+            if match:
+                selinux_spec_file = '/etc/selinux/{}/contexts/files/file_contexts'.format(match.group('policy'))
+        if not selinux_spec_file or not self.handle.exists(selinux_spec_file):
+            # Policy is not available, relabel on next boot
+            self.handle.touch('/.autorelabel')
+            return
+        paths = self.relabel_paths()
+        if paths == ['/']:
+            self.handle.rm_f('/.autorelabel')
+        for path in paths:
+            if self.handle.exists(path):
+                self.handle.selinux_relabel(selinux_spec_file, path, force=True)
+
+    def close(self, failed=False):
+        # 'failed' operations discard the overlay instead of committing it
         self.image = self.module.params.get('image')
+        if self.session and self.handle:
+            # Leave the served handle mounted for following tasks
+            with self.timer('detach'):
+                self.handle.close()
+            return True
+        if self.handle and self.readonly:
+            # Nothing to relabel or sync, changes are discarded
+            with self.timer('shutdown'):
+                self.handle.shutdown()
+                self.handle.close()
+            self.unlock_image()
+            return True
         if self.handle:
-            if self.mount:
-                # Relabel SELinux contexts
-                if self.se_relabel:
-                    selinux_config = self.handle.read_lines("/etc/selinux/config")
-                    re_policy = re.compile("SELINUXTYPE=(?P<policy>.*)")
-                    if re_policy:
-                        self.handle.rm_f("/.autorelabel")
-                        selinux_policy_line = list(filter(re_policy.match, selinux_config))
-                        if selinux_policy_line:
-                            selinux_policy_string = re.search(re_policy, selinux_policy_line[0])
-                            selinux_policy = selinux_policy_string.group('policy')
-                            selinux_spec_file = "/etc/selinux/{}/contexts/files/file_contexts".format(selinux_policy)
-                            if self.handle.exists(selinux_spec_file) == 1:
-                                self.handle.selinux_relabel(selinux_spec_file, "/", force=True)
-                    else:
-                        self.handle.touch("/.autorelabel")
-                self.handle.umount_all()
-            # Backwards compatibility,
-            # autosync is enabled by default since libguestfs 1.5.24
-            self.handle.sync()
-            # Shut off appliance before closing handle
-            self.handle.shutdown()
-            self.handle.close()
+            inspection_changed = False
+            if self.mounted:
+                # Unmounted filesystems were not changed
+                if self.inspection_cache and self.mountpoints:
+                    inspection_changed = self.inspection_checksums() != self.checksums
+                # Changes of a failed operation are discarded with the overlay
+                discarded = failed and self.overlay
+                if self.se_relabel and not discarded and (self.touched or self.module.params.get('selinux_relabel_full')):
+                    with self.timer('selinux_relabel'):
+                        self.relabel()
+                with self.timer('umount_sync'):
+                    self.handle.umount_all()
+            with self.timer('umount_sync'):
+                # Backwards compatibility,
+                # autosync is enabled by default since libguestfs 1.5.24
+                self.handle.sync()
+            with self.timer('shutdown'):
+                # Shut off appliance before closing handle
+                self.handle.shutdown()
+                self.handle.close()
+            image_written = True
+            if self.overlay:
+                with self.timer('commit'):
+                    image_written = self.finish_overlay(failed)
+            if self.inspection_cache and image_written:
+                # Image was written to, carry the inspection forward to its
+                # new identity unless a file it is derived from changed
+                if inspection_changed:
+                    drop_inspection(self.cache_dir, self.image)
+                else:
+                    store_inspection(self.cache_dir, self.image, image_identity(self.image),
+                                     self.inspection, self.checksums)
+            self.unlock_image()
             return True
+        self.unlock_image()
         return False
+
+
+# Parameters which do not affect the contents of a built layer
+LAYER_IGNORED_PARAMS = ['image', 'overlay', 'overlay_dest', 'build_cache', 'cache_dir', 'inspection_cache', 'session',
+                        'max_workers', 'image_lock', 'lock_timeout', 'profile', 'progress_file', 'appliance_memsize',
+                        'appliance_smp', 'backend', 'cachemode']
+
+
+def layer_key(module, sources):
+    """Returns build cache key of an operation, derived from the identity of
+    input image content, module parameters and digests of host sources."""
+
+    params = dict((name, value) for name, value in module.params.items() if name not in LAYER_IGNORED_PARAMS)
+    digests = dict((path, source_digest(path)) for path in sources)
+    cache_dir = module.params.get('cache_dir')
+    key = [content_identity(cache_dir, module.params['image']), params, digests]
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def restore_layer(module, key):
+    """Places a cached layer at 'overlay_dest', returns its results or None when not cached."""
+
+    cache_dir = module.params.get('cache_dir')
+    overlay_dest = module.params['overlay_dest']
+    results = load_layer(cache_dir, key)
+    if results is None:
+        return None
+    results['build_cache'] = 'hit'
+    if output_layer(cache_dir, overlay_dest) == key:
+        # Layer is already in place
+        results['changed'] = False
+        return results
+    try:
+        copy_file(layer_files(cache_dir, key)[0], overlay_dest)
+    except (IOError, OSError) as e:
+        module.fail_json(msg='Could not copy cached layer to {}: {}'.format(overlay_dest, str(e)))
+    record_output(cache_dir, overlay_dest, key)
+    results['changed'] = True
+    return results
+
+
+def expand_images(image):
+    """Returns image paths of 'image' parameter, a path, a glob pattern or a list of them."""
+
+    images = []
+    for pattern in image if isinstance(image, list) else [image]:
+        if glob.has_magic(pattern):
+            images.extend(sorted(glob.glob(pattern)))
+        else:
+            images.append(pattern)
+    return images
+
+
+def overlay_destination(params, image):
+    # '{image}' keeps overlays of several images apart
+    return params['overlay_dest'].replace('{image}', os.path.basename(image))
+
+
+# Operation and mode of fan out workers, set before the pool is forked since
+# operations (such as guestfs_batch steps) are closures which cannot be pickled
+_fan_out = {}
+
+
+def _run_image(params):
+    # Runs in a pool worker, every image gets its own appliance
+    try:
+        results, err = run_operation(guest_module(params), _fan_out['operation'], readonly=_fan_out['readonly'],
+                                     sources=_fan_out['sources'], cached=_fan_out['cached'])
+    except Exception as e:
+        results, err = {'changed': False, 'failed': True, 'msg': str(e)}, True
+    results['image'] = params['image']
+    return results, err
+
+
+def run_parallel(module, operation, images, readonly=False, sources=None, cached=None):
+    """Runs operation against each image in a pool of 'max_workers' processes.
+
+    Returns results of each image as 'images', in order of images.
+    """
+
+    results = {
+        'changed': False,
+        'failed': False,
+        'images': []
+    }
+    if not images:
+        results['failed'] = True
+        results['msg'] = 'No images matching {}'.format(module.params['image'])
+        return results, True
+    if module.params.get('overlay_dest') and \
+            len(set(overlay_destination(module.params, image) for image in images)) < len(images):
+        results['failed'] = True
+        results['msg'] = ("'overlay_dest' must contain '{image}' when 'image' matches several images, "
+                          "otherwise their overlays are renamed to the same path")
+        return results, True
+    workers = module.params.get('max_workers') or multiprocessing.cpu_count()
+    if workers < 1:
+        results['failed'] = True
+        results['msg'] = "'max_workers' must be a positive number"
+        return results, True
+
+    _fan_out.update(operation=operation, readonly=readonly, sources=sources, cached=cached)
+    # Workers are forked, spawned processes would not inherit the operation
+    context = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    pool = context.Pool(min(workers, len(images)))
+    try:
+        outcomes = pool.map(_run_image, [dict(module.params, image=image, max_workers=None) for image in images],
+                            chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _fan_out.clear()
+
+    failed = 0
+    for image_results, err in outcomes:
+        results['images'].append(image_results)
+        results['changed'] = results['changed'] or image_results.get('changed', False)
+        failed += 1 if err else 0
+    if failed:
+        results['failed'] = True
+        results['msg'] = 'Operation failed on {} of {} images'.format(failed, len(images))
+    return results, bool(failed)
+
+
+def run_operation(module, operation, readonly=False, sources=None, cached=None):
+    """Runs operation(guest, module) against a bootstrapped guest.
+
+    Returns the operation's results and error flag, results include
+    per-phase timings when 'profile' is enabled. When 'image' is a list
+    or a glob pattern, operation runs against each image in parallel.
+
+    'sources' are host paths read by the operation, operations providing
+    them only change the guest disk image and may use the build cache.
+    'cached(module)' returns results of the operation without launching
+    an appliance, or None when they are not available.
+    """
+
+    image = module.params['image']
+    if isinstance(image, list) or glob.has_magic(image):
+        images = expand_images(image)
+        return run_parallel(module, operation, images, readonly=readonly, sources=sources, cached=cached)
+
+    if module.params.get('overlay_dest'):
+        module.params['overlay_dest'] = overlay_destination(module.params, image)
+
+    if cached and os.path.exists(image):
+        outcome = cached(module)
+        if outcome is not None:
+            return outcome
+
+    key = None
+    if module.params.get('readonly') is not None:
+        readonly = module.params.get('readonly')
+    if module.params.get('build_cache') and sources is not None and not readonly:
+        if not module.params.get('overlay_dest'):
+            module.fail_json(msg="'build_cache' requires 'overlay_dest', guest disk image itself is never modified")
+        if module.params.get('session'):
+            module.fail_json(msg="'build_cache' can not be used with 'session', writes go to the session's handle "
+                                 "and no layer is built")
+        if os.path.exists(module.params['image']):
+            key = layer_key(module, sources)
+            results = restore_layer(module, key)
+            if results is not None:
+                return results, False
+        # Layer is built in an overlay like any other
+        module.params['overlay'] = True
+
+    g = guest(module)
+    instance = g.bootstrap(readonly=readonly)
+    try:
+        with g.timer('operation'):
+            results, err = operation(instance, module)
+    except BaseException:
+        g.close(failed=True)
+        raise
+    g.close(failed=err)
+    if key and not err:
+        cache_dir = module.params.get('cache_dir')
+        store_layer(cache_dir, key, module.params['overlay_dest'], results)
+        record_output(cache_dir, module.params['overlay_dest'], key)
+        results['build_cache'] = 'miss'
+    if 'lock_wait' in g.timings:
+        results['lock_wait'] = round(g.timings['lock_wait'], 3)
+    if module.params.get('profile'):
+        results['timings'] = g.profile()
+    return results, err
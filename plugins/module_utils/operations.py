@@ -0,0 +1,1041 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import bisect
+import glob
+import os
+import re
+import time
+from contextlib import contextmanager
+try:
+    import grp
+    import pwd
+except ImportError:
+    pass
+
+from .cache import DEFAULT_CACHE_DIR, load_inventory, locked, store_inventory
+from .transfer import (QUICK, file_checksum, local_signature, remote_signature, sync_in, sync_out, tar_download, tar_upload,
+                       transfer_progress, tree_size)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+# Reference file for finding paths changed by commands
+CHANGES_MARKER = '/tmp/.guestfs-changes-marker'
+
+# Lists paths changed since the marker was created, pseudo and temporary
+# filesystems are skipped
+FIND_CHANGES = ("find / \\( -path /proc -o -path /sys -o -path /dev -o -path /run -o -path /tmp \\) -prune "
+                "-o -cnewer {marker} -print")
+
+
+@contextmanager
+def nullcontext():
+    yield
+
+
+@contextmanager
+def tracked_changes(guest, module):
+    """Marks paths changed in guest within the block for targeted SELinux relabel.
+
+    Changes are only looked up when relabeling is requested, otherwise
+    the whole filesystem is marked.
+    """
+
+    if not module.params.get('selinux_relabel') or module.params.get('selinux_relabel_full'):
+        try:
+            yield
+        finally:
+            guest.mark_touched('/')
+        return
+
+    try:
+        guest.touch(CHANGES_MARKER)
+        tracking = True
+    except Exception:
+        tracking = False
+    try:
+        yield
+    finally:
+        changed = None
+        if tracking:
+            try:
+                changed = guest.sh_lines(FIND_CHANGES.format(marker=CHANGES_MARKER))
+                guest.rm_f(CHANGES_MARKER)
+            except Exception:
+                changed = None
+        if changed is None:
+            guest.mark_touched('/')
+        elif changed:
+            guest.mark_touched(*changed)
+
+
+def execute(guest, module):
+
+    results = {
+        'changed': False,
+        'failed': False,
+    }
+    err = False
+
+    # Create a command variable
+    if module.params['shell']:
+        cmd = module.params['shell']
+    elif module.params['command']:
+        cmd = module.params['command']
+
+    try:
+        guest.mount_paths('/')
+        with tracked_changes(guest, module):
+            if module.params['shell']:
+                result = guest.sh(cmd)
+            elif module.params['command']:
+                # Split sentence into words using regular expressions
+                cmd_args = re.findall(r'([^\s]+)', cmd)
+                result = guest.command(cmd_args)
+    except Exception as e:
+        err = True
+        results['failed'] = True
+        error_message = str(e)
+        if error_message in ['command: ', 'sh: ']:
+            error_message = 'command has returned stderr to shell but guestfs does not return it'
+        results['msg'] = error_message
+
+    if not err:
+        results['changed'] = True
+        results['stdout'] = result.rstrip('\n')
+        results['stdout_lines'] = results['stdout'].split('\n')
+
+    return results, err
+
+
+def upload(guest, module):
+
+    err = False
+    results = {
+        'changed': False,
+        'failed': False
+    }
+    checksum_src = None
+    checksum_dest = None
+    src = module.params['src']
+    dest = module.params['dest']
+    compression = module.params.get('compression') or 'none'
+    algorithm = module.params.get('checksum_algorithm') or 'md5'
+    progress = transfer_progress(guest, module.params.get('progress_file'))
+
+    if not os.path.exists(src):
+        err = True
+        results['failed'] = True
+        results['msg'] = 'Source path {path} not found'.format(path=src)
+
+    elif not os.access(src, os.R_OK):
+        err = True
+        results['failed'] = True
+        results['msg'] = 'Source path {path} not accessable'.format(path=src)
+
+    if not err:
+        try:
+            guest.mount_paths(dest)
+            # Check if source path is a file and not a directory/symlink
+            if not os.path.isfile(src) and not module.params['recursive']:
+                err = True
+                results['msg'] = "Source file is either directory or symlink, if it's a directory use 'recursive' argument"
+            else:
+                if module.params['recursive'] and module.params.get('incremental') and os.path.isdir(src):
+                    # Same layout as copy_in, which copies the directory itself
+                    # into dest even when src has a trailing separator
+                    dest = os.path.join(dest, os.path.basename(src.rstrip(os.path.sep)))
+                    results['uploaded'] = sync_in(guest, src, dest, algorithm, compression, progress)
+                    results['changed'] = bool(results['uploaded'])
+                elif module.params['recursive'] and compression != 'none' and os.path.isdir(src):
+                    dest = os.path.join(dest, os.path.basename(src.rstrip(os.path.sep)))
+                    tar_upload(guest, src, None, dest, compression, progress)
+                    results['changed'] = True
+                elif module.params['recursive']:
+                    with progress.measure():
+                        guest.copy_in(src, dest)
+                        progress.add(tree_size(src))
+                    # copy_in does not report changes, the copied tree is relabeled regardless
+                    guest.mark_touched(os.path.join(dest, os.path.basename(src.rstrip(os.path.sep))))
+                    if not src.endswith(os.path.sep):
+                        dest = dest + os.path.basename(src)
+                else:
+                    if dest.endswith(os.path.sep):
+                        dest = dest + os.path.basename(src)
+                    # Quick mode compares size and modification time, files are not hashed
+                    if algorithm == QUICK:
+                        differs = not guest.is_file(dest) or local_signature(src) != remote_signature(guest.lstatns(dest))
+                    else:
+                        checksum_src = file_checksum(src, algorithm)
+                        # Check if destination file exists on guest image
+                        if guest.is_file(dest):
+                            checksum_dest = guest.checksum(algorithm, dest)
+                        differs = checksum_src != checksum_dest
+                    # If source file and dest file are different, upload file to guest
+                    if differs:
+                        results['changed'] = True
+                        with progress.measure():
+                            guest.upload(src, dest)
+                            progress.add(os.path.getsize(src))
+                        if algorithm == QUICK:
+                            st = os.stat(src)
+                            guest.utimens(dest, int(st.st_atime), 0, int(st.st_mtime), 0)
+
+        except Exception as e:
+            err = True
+            results['failed'] = True
+            results['msg'] = str(e)
+
+        if not err:
+            results['src'] = src
+            '''
+            Not using 'dest' in results due to
+            'ansible.module_utils.basic' containing the method
+            'add_path_info' which attempts to retrieve info
+            regarding the path which does not exist on target host
+            (Fixed in Ansible 2.8,
+            commit: cc9c72d6f845710b24e952670b534a57f6948513)
+            '''
+            results['dest'] = dest
+
+            if checksum_src:
+                results['checksum'] = checksum_src
+                if algorithm == 'md5':
+                    results['md5'] = checksum_src
+            if results['changed']:
+                guest.mark_touched(dest)
+            if progress.bytes:
+                results['transfer'] = progress.results()
+
+    return results, err
+
+
+def download(guest, module):
+
+    err = False
+    results = {
+        'changed': False,
+        'failed': False,
+        'src': module.params['src'],
+    }
+    checksum_src = None
+    checksum_dest = None
+    src = module.params['src']
+    dest = module.params['dest']
+    compression = module.params.get('compression') or 'none'
+    algorithm = module.params.get('checksum_algorithm') or 'md5'
+    progress = transfer_progress(guest, module.params.get('progress_file'))
+
+    try:
+        guest.mount_paths(src)
+        # Check if source path is a file and not a directory/symlink
+        if not guest.is_file(src) and not module.params['recursive']:
+            err = True
+            results['msg'] = "Source file is either directory or symlink, if it's a directory use 'recursive' argument"
+        else:
+            if module.params['recursive'] and module.params.get('incremental'):
+                # Same layout as copy_out, which copies the directory itself
+                # into dest even when src has a trailing separator
+                dest = os.path.join(dest, os.path.basename(src.rstrip(os.path.sep)))
+                results['downloaded'] = sync_out(guest, src, dest, algorithm, compression, progress)
+                results['changed'] = bool(results['downloaded'])
+            elif module.params['recursive'] and compression != 'none':
+                dest = os.path.join(dest, os.path.basename(src.rstrip(os.path.sep)))
+                tar_download(guest, src, dest, compression=compression, progress=progress)
+                results['changed'] = True
+            elif module.params['recursive']:
+                if not src.endswith(os.path.sep):
+                    dest = dest + os.path.basename(src)
+                with progress.measure():
+                    guest.copy_out(src, dest)
+                    progress.add(tree_size(os.path.join(dest, os.path.basename(src.rstrip(os.path.sep)))))
+            else:
+                if dest.endswith(os.path.sep):
+                    dest = dest + os.path.basename(src)
+                # Quick mode compares size and modification time, files are not hashed
+                if algorithm == QUICK:
+                    st = guest.lstatns(src)
+                    differs = not os.path.isfile(dest) or local_signature(dest) != remote_signature(st)
+                else:
+                    checksum_src = guest.checksum(algorithm, src)
+                    # Check if destination file exists on host
+                    if os.path.isfile(dest):
+                        checksum_dest = file_checksum(dest, algorithm)
+                    differs = checksum_src != checksum_dest
+                # If source file and dest file are different, download file from guest
+                if differs:
+                    results['changed'] = True
+                    with progress.measure():
+                        guest.download(src, dest)
+                        progress.add(os.path.getsize(dest))
+                    if algorithm == QUICK:
+                        os.utime(dest, (st['st_atime_sec'], st['st_mtime_sec']))
+
+    except Exception as e:
+        err = True
+        results['failed'] = True
+        results['msg'] = str(e)
+
+    if not err:
+        results['md5sum'] = checksum_src if algorithm == 'md5' else None
+        if checksum_src:
+            results['checksum'] = checksum_src
+        results['dest'] = dest
+        if progress.bytes:
+            results['transfer'] = progress.results()
+
+    return results, err
+
+
+# Characters making a path a glob pattern
+GLOB_MAGIC = re.compile(r'[*?[]')
+
+
+def expand_sources(guest, pattern, local):
+    """Returns sorted paths matching a glob pattern on host (local) or in guest."""
+
+    if not GLOB_MAGIC.search(pattern):
+        return [pattern]
+    if local:
+        return sorted(glob.glob(pattern))
+    # Filesystems holding matches are under the pattern's literal prefix
+    prefix = []
+    for component in pattern.split('/'):
+        if GLOB_MAGIC.search(component):
+            break
+        prefix.append(component)
+    guest.mount_paths('/'.join(prefix) or '/')
+    return sorted(guest.glob_expand(pattern))
+
+
+def parse_mode(mode):
+    # Modes are octal strings ('0644'), integers were already converted by YAML
+    if mode is None or isinstance(mode, int):
+        return mode
+    return int(str(mode), 8)
+
+
+def _lookup_id(lines, name, kind):
+    if name.isdigit():
+        return int(name)
+    for line in lines:
+        fields = line.split(':')
+        if fields[0] == name and len(fields) > 2:
+            return int(fields[2])
+    raise ValueError('{kind} {name} does not exist'.format(kind=kind, name=name))
+
+
+def guest_owner(guest, owner):
+    """Returns (uid, gid) of an 'user[:group]' owner using guest's passwd and group databases, gid -1 keeps group."""
+
+    user, dummy, group = owner.partition(':')
+    uid = _lookup_id(guest.read_lines('/etc/passwd'), user, 'User')
+    gid = _lookup_id(guest.read_lines('/etc/group'), group, 'Group') if group else -1
+    return uid, gid
+
+
+def host_owner(owner):
+    user, dummy, group = owner.partition(':')
+    uid = int(user) if user.isdigit() else pwd.getpwnam(user).pw_uid
+    gid = -1
+    if group:
+        gid = int(group) if group.isdigit() else grp.getgrnam(group).gr_gid
+    return uid, gid
+
+
+def set_attributes(guest, path, mode, owner, local):
+    """Applies mode and owner to a path on host (local) or in guest, returns whether it was changed."""
+
+    changed = False
+    if local:
+        stat = os.lstat(path)
+        current = {'st_mode': stat.st_mode, 'st_uid': stat.st_uid, 'st_gid': stat.st_gid}
+    else:
+        current = guest.lstatns(path)
+    if mode is not None and current['st_mode'] & 0o7777 != mode:
+        if local:
+            os.chmod(path, mode)
+        else:
+            guest.chmod(mode, path)
+        changed = True
+    if owner:
+        uid, gid = host_owner(owner) if local else guest_owner(guest, owner)
+        if uid != current['st_uid'] or gid not in [-1, current['st_gid']]:
+            if local:
+                os.lchown(path, uid, gid)
+            else:
+                guest.lchown(uid, gid, path)
+            changed = True
+    return changed
+
+
+def copy_files(guest, module, operation):
+    """Runs upload or download for each item of 'files' and for each match of a glob 'src'.
+
+    A single plain 'src' is passed to the operation as is.
+    """
+
+    local = operation is upload
+    if module.params.get('files'):
+        items = module.params['files']
+    elif GLOB_MAGIC.search(module.params['src']):
+        items = [{'src': module.params['src'], 'dest': module.params['dest']}]
+    else:
+        return operation(guest, module)
+
+    results = {
+        'changed': False,
+        'failed': False,
+        'results': []
+    }
+    err = False
+    transferred = transfer_progress()
+    # Seconds reported by items are rounded, fast items would add up to
+    # nothing, the whole transfer is timed instead
+    start = _clock()
+
+    for item in items:
+        try:
+            sources = expand_sources(guest, item['src'], local)
+        except Exception as e:
+            sources = []
+            results['msg'] = str(e)
+        if not sources:
+            err = True
+            results['failed'] = True
+            results['msg'] = results.get('msg') or 'No files matching {path}'.format(path=item['src'])
+            break
+        dest = item['dest']
+        # Matches of a pattern are copied into 'dest' directory
+        if GLOB_MAGIC.search(item['src']) and not dest.endswith(os.path.sep):
+            dest = dest + os.path.sep
+
+        for source in sources:
+            params = dict(module.params, src=source, dest=dest, files=None)
+            item_results, err = operation(guest, step_module(module, params))
+            if not err and (item.get('mode') is not None or item.get('owner')):
+                try:
+                    if set_attributes(guest, item_results['dest'], parse_mode(item.get('mode')),
+                                      item.get('owner'), not local):
+                        item_results['changed'] = True
+                except Exception as e:
+                    err = True
+                    item_results['failed'] = True
+                    item_results['msg'] = str(e)
+            item_results.setdefault('src', source)
+            if 'transfer' in item_results:
+                transferred.bytes += item_results['transfer']['bytes']
+            results['results'].append(item_results)
+            results['changed'] = results['changed'] or item_results['changed']
+            if err:
+                results['failed'] = True
+                results['msg'] = item_results.get('msg')
+                break
+        if err:
+            break
+
+    if transferred.bytes:
+        transferred.seconds = _clock() - start
+        results['transfer'] = transferred.results()
+
+    return results, err
+
+
+def upload_sources(params):
+    """Returns host paths read by an upload, glob patterns are expanded."""
+
+    sources = []
+    for item in params.get('files') or [{'src': params['src']}]:
+        sources.extend(expand_sources(None, item['src'], True))
+    return sources
+
+
+def upload_files(guest, module):
+    return copy_files(guest, module, upload)
+
+
+def download_files(guest, module):
+    return copy_files(guest, module, download)
+
+
+# Commands of a transaction per package state, '{packages}' are the names
+# and '{options}' restrict installs to a local repository
+PACKAGE_MANAGERS = {
+    'dnf': {'present': 'dnf -y {options}install {packages}', 'absent': 'dnf -y remove {packages}',
+            'latest': 'dnf -y {options}install {packages} && dnf -y {options}upgrade {packages}'},
+    'yum': {'present': 'yum -y {options}install {packages}', 'absent': 'yum -y remove {packages}',
+            'latest': 'yum -y {options}install {packages} && yum -y {options}update {packages}'},
+    'apt': {'present': 'apt-get -q -y {options}-o Dpkg::Options::=--force-confnew install {packages}',
+            'absent': 'apt-get -q -y remove {packages}',
+            'latest': 'apt-get -q -y {options}-o Dpkg::Options::=--force-confnew install {packages}'}
+}
+
+# Guest directory a host 'local_repo' is uploaded to
+LOCAL_REPO_DIR = '/var/tmp/guestfs-local-repo'
+
+# Package manager -> (configuration file, its content, options selecting only the local repository)
+LOCAL_REPOS = {
+    'dnf': ('/etc/yum.repos.d/guestfs-local.repo',
+            '[guestfs-local]\nname=guestfs-local\nbaseurl=file://{path}\nenabled=0\ngpgcheck=0\n',
+            "--disablerepo='*' --enablerepo=guestfs-local "),
+    'apt': ('/etc/apt/sources.list.d/guestfs-local.list',
+            'deb [trusted=yes] file:{path} ./\n',
+            '-o Dir::Etc::sourcelist={config} -o Dir::Etc::sourceparts=- '),
+}
+LOCAL_REPOS['yum'] = LOCAL_REPOS['dnf']
+
+# Package manager -> (host files of a repository index, command indexing a directory of packages in guest)
+LOCAL_REPO_INDEXES = {
+    'dnf': (['repodata/repomd.xml'], 'createrepo_c -q {path} || createrepo -q {path}'),
+    'apt': (['Packages', 'Packages.gz', 'Packages.xz'],
+            'cd {path} && (apt-ftparchive packages . > Packages || dpkg-scanpackages -m . > Packages)'),
+}
+LOCAL_REPO_INDEXES['yum'] = LOCAL_REPO_INDEXES['dnf']
+
+# How 'list' is matched against package names
+PACKAGE_MATCHES = ['regex', 'exact', 'prefix']
+
+# Failure message of each match when no package matches 'list'
+PACKAGE_NOT_FOUND = {
+    'regex': "Packages containing regular expression '{list}' not found",
+    'exact': "Package '{list}' not found",
+    'prefix': "Packages starting with '{list}' not found",
+}
+
+# Transactions run in this order, removals first
+PACKAGE_STATES = ['absent', 'present', 'latest']
+
+# Touched after refreshing apt lists, same stamp as apt's daily job
+APT_UPDATE_STAMP = '/var/lib/apt/periodic/update-success-stamp'
+
+
+def package_transactions(params):
+    """Returns (state, names) of the package manager transactions requested
+    by 'name' and 'state' or by 'packages', raises ValueError if invalid."""
+
+    entries = params.get('packages') or [{'name': params['name'], 'state': params['state']}]
+    requested = {}
+    names = dict((state, []) for state in PACKAGE_STATES)
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get('name'):
+            raise ValueError("Each element of 'packages' is expected to be a dictionary with 'name'")
+        state = entry.get('state') or 'present'
+        if state not in PACKAGE_STATES:
+            raise ValueError("Package state '{}' is not one of: {}".format(state, ', '.join(PACKAGE_STATES)))
+        for name in entry['name'] if isinstance(entry['name'], list) else [entry['name']]:
+            if requested.setdefault(name, state) != state:
+                raise ValueError("Package '{}' is requested both {} and {}".format(name, requested[name], state))
+            if name not in names[state]:
+                names[state].append(name)
+    return [(state, names[state]) for state in PACKAGE_STATES if names[state]]
+
+
+# Names which can be compared with installed package names, excluding globs and paths
+PLAIN_PACKAGE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.+:-]*$')
+
+
+def installed_packages(guest):
+    """Returns names of packages installed in guest (also suffixed with
+    architecture), None when applications could not be listed."""
+
+    for mount in guest.mounts():
+        apps = guest.inspect_list_applications2(mount)
+        if apps:
+            installed = set()
+            for app in apps:
+                installed.add(app['app2_name'])
+                installed.add('{name}.{arch}'.format(name=app['app2_name'], arch=app['app2_arch']))
+                installed.add('{name}:{arch}'.format(name=app['app2_name'], arch=app['app2_arch']))
+            return installed
+    return None
+
+
+def pending_transactions(transactions, installed, response):
+    """Returns transactions without packages already present, which are
+    reported in response. Upgrades and removals are always pending, as names
+    not installed may still be provided by an installed package ('nc' by
+    'nmap-ncat')."""
+
+    pending = []
+    for state, names in transactions:
+        if state == 'present' and installed is not None:
+            satisfied = [name for name in names if PLAIN_PACKAGE.match(name) and name in installed]
+            for name in satisfied:
+                response.add('{package} is already {state}'.format(package=name, state=state))
+            names = [name for name in names if name not in satisfied]
+        if names:
+            pending.append((state, names))
+    return pending
+
+
+def add_local_repo(guest, package_manager, local_repo):
+    """Uploads a host directory of packages (or a repository) to guest and
+    configures it as a repository, returns package manager options using it."""
+
+    config, content, options = LOCAL_REPOS[package_manager]
+    indexes, index_command = LOCAL_REPO_INDEXES[package_manager]
+    guest.rm_rf(LOCAL_REPO_DIR)
+    tar_upload(guest, local_repo, None, LOCAL_REPO_DIR)
+    if not any(os.path.exists(os.path.join(local_repo, index)) for index in indexes):
+        guest.sh(index_command.format(path=LOCAL_REPO_DIR))
+    guest.write(config, content.format(path=LOCAL_REPO_DIR).encode('utf-8'))
+    options = options.format(config=config)
+    if package_manager == 'apt':
+        # Only the local list is refreshed, lists of other sources are kept
+        guest.sh_lines('apt-get -q -y {options}-o APT::Get::List-Cleanup=0 update'.format(options=options))
+    return options
+
+
+def remove_local_repo(guest, package_manager):
+    config = LOCAL_REPOS[package_manager][0]
+    guest.rm_f(config)
+    guest.rm_rf(LOCAL_REPO_DIR)
+    if package_manager == 'apt':
+        for path in guest.glob_expand('/var/lib/apt/lists/*guestfs-local-repo*'):
+            guest.rm_f(path)
+
+
+# Package manager -> (guest download cache, command emptying it, options keeping downloads)
+DOWNLOAD_CACHES = {
+    'dnf': ('/var/cache/dnf', 'dnf clean packages', '--setopt=keepcache=True '),
+    'yum': ('/var/cache/yum', 'yum clean packages', '--setopt=keepcache=1 '),
+    'apt': ('/var/cache/apt/archives', 'apt-get clean', '-o APT::Keep-Downloaded-Packages=true '),
+}
+
+
+def download_cache_dir(guest, module, root):
+    # Downloads are shared by guests of the same distribution, release and architecture
+    name = '{distro}-{major}.{minor}-{arch}'.format(distro=guest.inspect_get_distro(root),
+                                                    major=guest.inspect_get_major_version(root),
+                                                    minor=guest.inspect_get_minor_version(root),
+                                                    arch=guest.inspect_get_arch(root))
+    return os.path.join(os.path.expanduser(module.params.get('cache_dir') or DEFAULT_CACHE_DIR), 'packages', name)
+
+
+@contextmanager
+def download_cache(guest, package_manager, cache):
+    """Keeps guest package downloads on host, yields the list of downloads saved on exit.
+
+    With a scratch drive, the guest download cache is mounted from it and seeded
+    with packages downloaded by previous runs, so no download is ever written to
+    the guest disk image. Without one (in a session), downloads are only saved
+    and the guest download cache is emptied, as the clusters they took remain
+    allocated in the disk image.
+    """
+
+    guest_cache, clean_command = DOWNLOAD_CACHES[package_manager][:2]
+    device = guest.scratch_drive()
+    if device:
+        formatted = guest.once('scratch-filesystem')
+        if formatted:
+            guest.mkfs('ext4', device)
+        guest.mkdir_p(guest_cache)
+        guest.mount(device, guest_cache)
+        if formatted:
+            guest.rm_rf(guest_cache + '/lost+found')
+        if os.path.isdir(cache):
+            with locked(cache + '.lock', shared=True):
+                sync_in(guest, cache, guest_cache, QUICK)
+    saved = []
+    try:
+        yield saved
+    finally:
+        if guest.is_dir(guest_cache):
+            with locked(cache + '.lock'):
+                saved.extend(sync_out(guest, guest_cache, cache, QUICK))
+        if device:
+            guest.umount(guest_cache)
+        else:
+            guest.sh(clean_command)
+
+
+def refresh_apt_lists(guest, cache_valid_time):
+    # Lists are refreshed at most once per handle (sessions and batches run
+    # several package operations), and not when refreshed recently
+    if not guest.once('apt-update'):
+        return False
+    if cache_valid_time and guest.exists(APT_UPDATE_STAMP):
+        if time.time() - guest.lstatns(APT_UPDATE_STAMP)['st_mtime_sec'] < cache_valid_time:
+            return False
+    guest.sh_lines('apt-get -q -y update')
+    guest.mkdir_p(os.path.dirname(APT_UPDATE_STAMP))
+    guest.touch(APT_UPDATE_STAMP)
+    return True
+
+
+def parse_transaction(package_manager, state, names, lines, results, response):
+    # Collects changed packages of a transaction's output into response
+    if package_manager in ['yum', 'dnf']:
+        for line in lines:
+            for package in names:
+                if package in line:
+                    if 'Verifying' in line:
+                        results['changed'] = True
+                        # Split sentence into words using regular expressions
+                        invoked_package = re.findall(r'([^\s]+)', line)[2]
+                        response.add('{package} is {state}'.format(package=invoked_package, state=state))
+                    elif 'already installed' in line:
+                        response.add(line.replace('Package ', ''))
+                    elif 'No package {package} available.'.format(package=package) in line:
+                        results['failed'] = True
+                        results['msg'] = line
+
+                if 'No Packages marked for removal' in line:
+                    response.add(line)
+
+    elif package_manager == 'apt':
+        for line in lines:
+            for package in names:
+                if package in line:
+                    if "Unpacking" in line or "Removing" in line:
+                        results['changed'] = True
+                        # Substitute string using regular expression and remove CR
+                        invoked_package = re.sub(r'Unpacking|Removing', '', line).replace(' ...\r', '')
+                        response.add('{package} is {state}'.format(package=invoked_package, state=state))
+                    elif "aready" in line or "not installed" in line:
+                        response.add(line)
+
+
+def package_inventory(apps):
+    """Returns packages of inspect_list_applications2 as dictionaries, sorted by name."""
+
+    inventory = [{
+        'name': app['app2_name'],
+        'epoch': app['app2_epoch'],
+        'version': app['app2_version'],
+        'release': app['app2_release'],
+        'arch': app['app2_arch'],
+        'source': app['app2_source_package'],
+    } for app in apps]
+    return sorted(inventory, key=lambda package: (package['name'], package['arch']))
+
+
+def find_packages(inventory, pattern, match='regex'):
+    """Returns packages of an inventory sorted by name whose name matches pattern, '*' matches all.
+
+    Names match a regular expression from their start, or are equal to
+    pattern ('exact') or start with it ('prefix'), found by bisecting the
+    sorted names.
+    """
+
+    if pattern == '*':
+        return list(inventory)
+    if match == 'regex':
+        regex = re.compile(pattern)
+        return [package for package in inventory if regex.match(package['name'])]
+    names = [package['name'] for package in inventory]
+    start = end = bisect.bisect_left(names, pattern)
+    while end < len(names) and (names[end] == pattern if match == 'exact' else names[end].startswith(pattern)):
+        end += 1
+    return inventory[start:end]
+
+
+def inventory_path(params):
+    # '{image}' keeps inventories of several images apart
+    return params['inventory_file'].replace('{image}', os.path.basename(params['image']))
+
+
+def list_packages(inventory, params):
+    """Returns results of listing packages of an inventory matching 'list'."""
+
+    results = {
+        'changed': False,
+        'failed': False
+    }
+    match = params.get('match') or 'regex'
+    try:
+        matches = find_packages(inventory, params['list'], match)
+    except re.error as e:
+        results['failed'] = True
+        results['msg'] = "Invalid regular expression '{regexp}': {error}".format(regexp=params['list'], error=str(e))
+        return results, True
+    if not matches:
+        results['failed'] = True
+        results['msg'] = PACKAGE_NOT_FOUND[match].format(list=params['list'])
+        return results, True
+    if params.get('inventory'):
+        results['results'] = matches
+    else:
+        results['results'] = ['{name}-{version}-{release}-{arch}'.format(**package) for package in matches]
+    return results, False
+
+
+def cached_inventory(module):
+    """Returns results of listing packages from an up to date 'inventory_file', None when there is none."""
+
+    if not module.params.get('list') or not module.params.get('inventory_file'):
+        return None
+    inventory = load_inventory(inventory_path(module.params), module.params['image'])
+    if inventory is None:
+        return None
+    return list_packages(inventory, module.params)
+
+
+def packages(guest, module):
+
+    results = {
+        'changed': False,
+        'failed': False
+    }
+    # Use set to be converted into list since yum/dnf querying could contain same value multiple times
+    response = set()
+    err = False
+    # Package managers and application listing read the whole guest filesystem
+    guest.mount_paths('/')
+
+    if module.params['name'] or module.params.get('packages'):
+        package_manager = None
+        for root in guest.mounts():
+            package_manager = guest.inspect_get_package_management(root)
+            # If libguest managed to find package manager, quit loop
+            if package_manager != 'unknown' and package_manager:
+                break
+
+        if package_manager in PACKAGE_MANAGERS:
+            log = []
+            try:
+                transactions = package_transactions(module.params)
+                # Skip package manager (and its metadata refresh) for
+                # packages found in the installed package database
+                if any(state == 'present' for state, names in transactions):
+                    transactions = pending_transactions(transactions, installed_packages(guest), response)
+                local_repo = module.params.get('local_repo')
+                if not any(state != 'absent' for state, names in transactions):
+                    local_repo = None
+                # Packages installed from a local repository are not downloaded
+                cache = None
+                if module.params.get('download_cache') and not local_repo and \
+                        any(state != 'absent' for state, names in transactions):
+                    cache = download_cache_dir(guest, module, root)
+                with tracked_changes(guest, module) if transactions else nullcontext(), \
+                        download_cache(guest, package_manager, cache) if cache else nullcontext() as saved:
+                    options = ''
+                    if local_repo:
+                        options = add_local_repo(guest, package_manager, local_repo)
+                    elif cache:
+                        options = DOWNLOAD_CACHES[package_manager][2]
+                        results['cached_downloads'] = saved
+                    try:
+                        # One transaction per state
+                        for state, names in transactions:
+                            if package_manager == 'apt' and state != 'absent' and not local_repo:
+                                refresh_apt_lists(guest, module.params.get('cache_valid_time'))
+                            result = guest.sh_lines(PACKAGE_MANAGERS[package_manager][state].format(
+                                packages=' '.join(names), options=options))
+                            log.extend(result)
+                            parse_transaction(package_manager, state, names, result, results, response)
+                            if results['failed']:
+                                break
+                    finally:
+                        if local_repo:
+                            remove_local_repo(guest, package_manager)
+            except Exception as e:
+                err = True
+                results['failed'] = True
+                results['msg'] = str(e)
+
+            if package_manager in ['yum', 'dnf'] and log:
+                results['log'] = '\n'.join(log)
+            if not err:
+                results['results'] = list(sorted(response))
+                # Package manager reported a failure
+                err = results['failed']
+
+        else:
+            err = True
+            results['msg'] = 'Package manager {package_manager} is not supported'.format(package_manager=package_manager)
+
+    elif module.params['list']:
+        inventory = []
+        for root in guest.mounts():
+            apps = guest.inspect_list_applications2(root)
+            if apps:
+                inventory = package_inventory(apps)
+                break
+        if inventory and module.params.get('inventory_file'):
+            store_inventory(inventory_path(module.params), module.params['image'], inventory)
+        return list_packages(inventory, module.params)
+
+    return results, err
+
+
+USER_DATABASES = ['/etc/passwd', '/etc/passwd-', '/etc/shadow', '/etc/shadow-', '/etc/group', '/etc/group-',
+                  '/etc/gshadow', '/etc/gshadow-', '/etc/subuid', '/etc/subgid']
+
+
+def users(guest, module):
+
+    state = module.params['state']
+    user_name = module.params['name']
+    user_password = module.params['password']
+    results = {
+        'changed': False,
+        'failed': False,
+        'results': []
+    }
+    err = False
+    guest.mount_paths('/')
+
+    try:
+        guest.sh_lines('id -u {}'.format(user_name))
+        user_exists = True
+    except Exception:
+        user_exists = False
+
+    if state == 'present':
+        if user_exists:
+            try:
+                guest.sh_lines('echo {u}:{p} | chpasswd'.format(u=user_name,
+                                                                p=user_password))
+            except Exception as e:
+                err = True
+                results['failed'] = True
+                results['msg'] = str(e)
+
+        else:
+            try:
+                guest.sh_lines('useradd {user}'.format(user=user_name))
+                guest.sh_lines('{u}:{p} | chpasswd'.format(u=user_name,
+                                                           p=user_password))
+            except Exception as e:
+                err = True
+                results['failed'] = True
+                results['msg'] = str(e)
+
+    elif state == 'absent':
+        if user_exists:
+            try:
+                guest.sh_lines('userdel {user}'.format(user=user_name))
+            except Exception as e:
+                err = True
+                results['failed'] = True
+                results['msg'] = str(e)
+
+    if not err:
+        results['changed'] = True
+        results['results'].append('{u} is {s}'.format(u=user_name, s=state))
+        # Databases are replaced by shadow utilities, home is created by useradd
+        guest.mark_touched(*(USER_DATABASES + ['/home/{}'.format(user_name), '/var/spool/mail/{}'.format(user_name)]))
+
+    return results, err
+
+
+class step_module():
+    # Exposes a single batch step as module parameters to the operations above,
+    # module wide parameters (for example 'selinux_relabel') remain visible
+    def __init__(self, module, params):
+        self.params = dict(module.params, **params)
+        self.md5 = module.md5
+
+
+# Operation name -> (function, default parameters)
+OPERATIONS = {
+    'shell': (execute, {'shell': None, 'command': None}),
+    'command': (execute, {'shell': None, 'command': None}),
+    'upload': (upload_files, {'src': None, 'dest': None, 'files': None, 'recursive': False, 'incremental': False,
+                              'compression': 'none', 'checksum_algorithm': 'md5'}),
+    'download': (download_files, {'src': None, 'dest': None, 'files': None, 'recursive': False, 'incremental': False,
+                                  'compression': 'none', 'checksum_algorithm': 'md5'}),
+    'package': (packages, {'name': None, 'state': None, 'list': None, 'packages': None, 'cache_valid_time': 0,
+                           'local_repo': None, 'download_cache': False, 'inventory': False, 'match': 'regex',
+                           'inventory_file': None}),
+    'user': (users, {'name': None, 'password': None, 'state': None}),
+}
+
+
+def step_params(step):
+    """Returns (operation, parameters) of a batch step, raises ValueError if invalid."""
+
+    if not isinstance(step, dict) or len(step.keys()) != 1:
+        raise ValueError("Step '{}' is expected to be a dictionary with a single key".format(step))
+    operation, options = list(step.items())[0]
+    if operation not in OPERATIONS:
+        raise ValueError("Unsupported operation '{}', supported operations: {}".format(
+            operation, ', '.join(sorted(OPERATIONS))))
+    params = dict(OPERATIONS[operation][1])
+    if operation in ['shell', 'command']:
+        params[operation] = options
+    elif not isinstance(options, dict):
+        raise ValueError("Operation '{}' expects a dictionary of options".format(operation))
+    else:
+        unknown = set(options) - set(params)
+        if unknown:
+            raise ValueError("Unsupported options for operation '{}': {}".format(operation, ', '.join(sorted(unknown))))
+        params.update(options)
+
+    if operation in ['upload', 'download']:
+        if bool(params['files']) == bool(params['src']) or (params['src'] and not params['dest']):
+            raise ValueError("Operation '{}' requires either 'src' and 'dest' or 'files'".format(operation))
+        for item in params['files'] or []:
+            if not isinstance(item, dict) or not (item.get('src') and item.get('dest')):
+                raise ValueError("Operation '{}' requires 'src' and 'dest' in each of 'files'".format(operation))
+    if operation == 'package':
+        if [bool(params['name']), bool(params['list']), bool(params['packages'])].count(True) != 1:
+            raise ValueError("Operation 'package' requires exactly one of 'name', 'list' or 'packages'")
+        if params['name']:
+            if not isinstance(params['name'], list):
+                params['name'] = [params['name']]
+            if params['state'] not in PACKAGE_STATES:
+                raise ValueError("Operation 'package' requires 'state' to be one of: {}".format(', '.join(PACKAGE_STATES)))
+        if params['name'] or params['packages']:
+            package_transactions(params)
+        if params['match'] not in PACKAGE_MATCHES:
+            raise ValueError("Operation 'package' requires 'match' to be one of: {}".format(', '.join(PACKAGE_MATCHES)))
+        if params['local_repo'] and not os.path.isdir(params['local_repo']):
+            raise ValueError("Local repository '{}' is not a directory".format(params['local_repo']))
+    if operation == 'user':
+        if not params['name'] or params['state'] not in ['present', 'absent']:
+            raise ValueError("Operation 'user' requires 'name' and 'state' (present, absent)")
+        if params['state'] == 'present' and not params['password']:
+            raise ValueError('Please provide password when using present state')
+    return operation, params
+
+
+def step_sources(steps):
+    """Returns host paths read by batch steps, None when a step writes to host."""
+
+    sources = []
+    for operation, params in steps:
+        if operation == 'download':
+            return None
+        if operation == 'upload':
+            sources.extend(upload_sources(params))
+        if operation == 'package' and params['local_repo']:
+            sources.append(params['local_repo'])
+    return sources
+
+
+def readonly_step(operation, params):
+    return operation == 'download' or (operation == 'package' and bool(params['list']))
+
+
+def run_steps(guest, module, steps):
+    """Runs batch steps in order against a single handle, stops at first failure."""
+
+    results = {
+        'changed': False,
+        'failed': False,
+        'results': []
+    }
+    err = False
+
+    for index, (operation, params) in enumerate(steps):
+        step_results, err = OPERATIONS[operation][0](guest, step_module(module, params))
+        step_results['step'] = index
+        step_results['operation'] = operation
+        results['results'].append(step_results)
+        if step_results.get('changed'):
+            results['changed'] = True
+        if err:
+            results['failed'] = True
+            results['msg'] = 'Step {} ({}) failed: {}'.format(index, operation, step_results.get('msg'))
+            break
+
+    return results, err
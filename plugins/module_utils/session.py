@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2018, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import base64
+import fcntl
+import json
+import os
+import socket
+
+# A session is a detached helper process which owns a launched and mounted
+# libguestfs handle and serves calls to it over a local UNIX socket.
+# Every request and response is a single line of JSON:
+#   request:  {"method": "sh", "args": ["ls /"], "kwargs": {}}
+#   response: {"result": ...} or {"error": "..."}
+
+SESSION_READY = b'ready'
+# Calls served to clients: methods of the served guest wrapper (cached
+# inspection, lazy mounts, relabel tracking) and the libguestfs handle calls
+# made by operations and the connection plugin. Everything else, such as
+# locks, overlay, mounts, sync or shutdown, belongs to the lifecycle of the
+# appliance shared by every client, which is owned by the session helper
+SESSION_METHODS = ['inspect_os', 'inspect_get_mountpoints', 'inspect_get_type', 'inspect_get_distro',
+                   'inspect_get_package_management', 'inspect_get_major_version', 'inspect_get_minor_version',
+                   'inspect_get_arch', 'mark_touched', 'once', 'mount_paths', 'scratch_drive']
+SESSION_CALLS = ['checksum', 'checksums_out', 'chmod', 'command', 'copy_in', 'copy_out', 'download', 'exists', 'find',
+                 'glob_expand', 'inspect_list_applications2', 'is_dir', 'is_file', 'lchown', 'lstatns', 'lstatnslist',
+                 'mkdir_p', 'mounts', 'read_file', 'read_lines', 'rm_f', 'rm_rf', 'sh', 'sh_lines', 'tar_in', 'tar_out',
+                 'touch', 'upload', 'utimens', 'write']
+
+
+def _encode(obj):
+    # Binary payloads (read_file, write, ...) can not be represented in JSON
+    if isinstance(obj, bytes):
+        return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def _decode(obj):
+    if '__bytes__' in obj and len(obj) == 1:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+def _send(sock, message):
+    sock.sendall(json.dumps(message, default=_encode).encode('utf-8') + b'\n')
+
+
+def _receive(stream):
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'), object_hook=_decode)
+
+
+class SessionClient():
+    """Proxy to a handle served by a session, forwards every method call."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.stream = self.sock.makefile('rb')
+
+    def call(self, method, *args, **kwargs):
+        _send(self.sock, {'method': method, 'args': args, 'kwargs': kwargs})
+        response = _receive(self.stream)
+        if response is None:
+            raise RuntimeError('Session {} closed the connection'.format(self.path))
+        if 'error' in response:
+            # Mimic libguestfs python bindings which raise RuntimeError
+            raise RuntimeError(response['error'])
+        return response.get('result')
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def remote_call(*args, **kwargs):
+            return self.call(method, *args, **kwargs)
+        return remote_call
+
+    def close(self):
+        # Only detach from session, the served handle is left running
+        self.stream.close()
+        self.sock.close()
+
+
+def session_alive(path):
+    if not os.path.exists(path):
+        return False
+    try:
+        client = SessionClient(path)
+        client.call('__info__')
+        client.close()
+    except (socket.error, RuntimeError, ValueError):
+        return False
+    return True
+
+
+def session_info(path):
+    client = SessionClient(path)
+    info = client.call('__info__')
+    client.close()
+    return info
+
+
+def stop_session(path):
+    client = SessionClient(path)
+    # Reply is sent only after handle was synced and shut down
+    client.call('__stop__')
+    client.close()
+
+
+def _served(method):
+    # Whether clients may call 'method' on the served guest
+    return method in SESSION_METHODS or method in SESSION_CALLS
+
+
+def _serve(g, server, path, idle_timeout):
+    running = True
+    if idle_timeout:
+        server.settimeout(idle_timeout)
+    try:
+        while running:
+            try:
+                conn, dummy = server.accept()
+            except socket.timeout:
+                break
+            conn.settimeout(None)
+            stream = conn.makefile('rb')
+            try:
+                while True:
+                    try:
+                        request = _receive(stream)
+                    except ValueError:
+                        break
+                    if request is None:
+                        break
+                    method = request.get('method')
+                    if method == '__info__':
+                        response = {'result': {'image': g.image, 'pid': os.getpid()}}
+                    elif method == '__stop__':
+                        running = False
+                        g.close()
+                        response = {'result': True}
+                    elif not _served(method):
+                        response = {'error': 'Method {} can not be called on a session'.format(method)}
+                    else:
+                        try:
+                            result = getattr(g, method)(*request.get('args', []),
+                                                        **request.get('kwargs', {}))
+                            response = {'result': result}
+                        except Exception as e:
+                            response = {'error': str(e)}
+                    try:
+                        _send(conn, response)
+                    except TypeError as e:
+                        _send(conn, {'error': str(e)})
+                    if not running:
+                        break
+            except socket.error:
+                pass
+            finally:
+                stream.close()
+                conn.close()
+    finally:
+        if running:
+            g.close()
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def start_session(g, path, idle_timeout=0):
+    """Spawn a detached helper bootstrapping 'g' and serving it on 'path'.
+
+    Returns None once the session is ready, otherwise an error message.
+    """
+
+    if os.path.exists(path):
+        if session_alive(path):
+            return 'Session {} is already running'.format(path)
+        # Left over from a helper which did not exit cleanly
+        os.unlink(path)
+
+    read_fd, write_fd = os.pipe()
+    # Appliance processes spawned by the helper must not hold the pipe open
+    fcntl.fcntl(write_fd, fcntl.F_SETFD, fcntl.fcntl(write_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            os.setsid()
+            if os.fork() != 0:
+                os._exit(0)
+            os.umask(0o077)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            g.bootstrap()
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(1)
+        except BaseException as e:
+            os.write(write_fd, str(e).encode('utf-8') or b'Session helper failed')
+            os._exit(1)
+        os.write(write_fd, SESSION_READY)
+        os.close(write_fd)
+        try:
+            _serve(g, server, path, idle_timeout)
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    status = b''
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        status += chunk
+    os.close(read_fd)
+    if status == SESSION_READY:
+        return None
+    if not status:
+        return 'Session helper exited unexpectedly'
+    return status.decode('utf-8', 'replace')
@@ -0,0 +1,538 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import hashlib
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    HAS_FUTURES = True
+except ImportError:
+    HAS_FUTURES = False
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# hashlib releases the GIL while hashing, threads hash files concurrently
+HASH_WORKERS = min(32, (getattr(os, 'cpu_count', lambda: None)() or 1) + 4)
+
+# Guest paths are not guaranteed to be valid UTF-8
+PATH_ERRORS = 'surrogateescape' if sys.version_info[0] >= 3 else 'replace'
+
+# Compression of tar streams -> tarfile stream compression, compressors
+# missing from the standard library run as a host process
+COMPRESSION = {
+    'none': '',
+    'gzip': 'gz',
+    'xz': 'xz',
+    'zstd': '',
+}
+COMPRESSORS = {
+    'zstd': ['zstd', '-q', '-c'],
+}
+
+# Compares size and modification time instead of checksums, like rsync
+QUICK = 'quick'
+
+# Paths stated by a single lstatnslist call
+STAT_BATCH = 1000
+
+
+def file_checksum(path, algorithm='md5'):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def local_tree(root):
+    """Returns relative paths of regular files and of other entries (directories, symlinks) under root."""
+
+    files = []
+    others = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            relative = os.path.relpath(path, root)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append(relative)
+            else:
+                others.append(relative)
+    return sorted(files), sorted(others)
+
+
+def tree_size(root):
+    files, others = local_tree(root)
+    return sum(os.path.getsize(os.path.join(root, name)) for name in files)
+
+
+def local_checksums(root, files, algorithm='md5'):
+    paths = [os.path.join(root, name) for name in files]
+    if HAS_FUTURES and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            checksums = list(pool.map(lambda path: file_checksum(path, algorithm), paths))
+    else:
+        checksums = [file_checksum(path, algorithm) for path in paths]
+    return dict(zip(files, checksums))
+
+
+def source_digest(path):
+    """Returns sha256 digest of a host file or directory tree (names, symlink targets and file contents)."""
+
+    if not os.path.isdir(path):
+        return file_checksum(path, 'sha256') if os.path.isfile(path) else None
+    files, others = local_tree(path)
+    digest = hashlib.sha256()
+    for name, checksum in sorted(local_checksums(path, files, 'sha256').items()):
+        digest.update('{}\0{}\0'.format(name, checksum).encode('utf-8', PATH_ERRORS))
+    for name in others:
+        target = os.readlink(os.path.join(path, name)) if os.path.islink(os.path.join(path, name)) else ''
+        digest.update('{}\0{}\0'.format(name, target).encode('utf-8', PATH_ERRORS))
+    return digest.hexdigest()
+
+
+def parse_checksums(data):
+    # Lines are produced by '<algorithm>sum' for every file found under
+    # the directory: '<checksum>  ./relative/path', names containing a
+    # newline or backslash are escaped and the line is prefixed with '\'
+    checksums = {}
+    for line in data.decode('utf-8', PATH_ERRORS).split('\n'):
+        if not line:
+            continue
+        escaped = line.startswith('\\')
+        if escaped:
+            line = line[1:]
+        checksum, name = line.split('  ', 1)
+        if escaped:
+            name = name.replace('\\n', '\n').replace('\\\\', '\\')
+        if name.startswith('./'):
+            name = name[2:]
+        checksums[name] = checksum
+    return checksums
+
+
+def remote_checksums(guest, directory, algorithm='md5'):
+    """Returns checksums of all files under a guest directory using a single call."""
+
+    fd, path = tempfile.mkstemp(prefix='guestfs-checksums-')
+    os.close(fd)
+    try:
+        guest.checksums_out(algorithm, directory, path)
+        with open(path, 'rb') as f:
+            return parse_checksums(f.read())
+    finally:
+        os.unlink(path)
+
+
+def local_signature(path):
+    st = os.stat(path)
+    # tar archives and guest stat keep whole seconds
+    return '{}:{}'.format(st.st_size, int(st.st_mtime))
+
+
+def remote_signature(st):
+    return '{}:{}'.format(st['st_size'], st['st_mtime_sec'])
+
+
+def local_signatures(root, files, algorithm='md5'):
+    if algorithm == QUICK:
+        return dict((name, local_signature(os.path.join(root, name))) for name in files)
+    return local_checksums(root, files, algorithm)
+
+
+def remote_signatures(guest, directory, algorithm='md5'):
+    """Returns signatures of regular files and all entries under a guest directory."""
+
+    if not guest.is_dir(directory):
+        return {}, set()
+    entries = set(name for name in guest.find(directory) if name)
+    if algorithm != QUICK:
+        return remote_checksums(guest, directory, algorithm), entries
+
+    signatures = {}
+    names = sorted(entries)
+    for index in range(0, len(names), STAT_BATCH):
+        batch = names[index:index + STAT_BATCH]
+        for name, st in zip(batch, guest.lstatnslist(directory, batch)):
+            if stat.S_ISREG(st['st_mode']):
+                signatures[name] = remote_signature(st)
+    return signatures, entries
+
+
+def pack(root, names, fileobj, compression='none'):
+    # Entries are added non-recursively, only the requested names are
+    # packed, without names the whole tree is packed
+    tar = tarfile.open(fileobj=fileobj, mode='w|' + COMPRESSION[compression])
+    try:
+        if names is None:
+            for name in sorted(os.listdir(root)):
+                tar.add(os.path.join(root, name), arcname=name)
+        for name in names or []:
+            tar.add(os.path.join(root, name), arcname=name, recursive=False)
+    finally:
+        tar.close()
+
+
+def compress_options(compression):
+    return {'compress': compression} if compression != 'none' else {}
+
+
+class transfer_progress():
+    """Counts bytes passed to or from the appliance and time spent transferring them.
+
+    When a progress file is provided, progress is appended to it as lines
+    which can be followed with 'tail -f' during long transfers.
+    """
+
+    # Seconds between lines written to progress file
+    INTERVAL = 1.0
+
+    def __init__(self, guest=None, path=None):
+        self.guest = guest
+        self.path = path
+        self.bytes = 0
+        self.seconds = 0.0
+        self.started = None
+        self.reported = 0.0
+        self.position = None
+
+    @contextmanager
+    def measure(self):
+        # libguestfs progress events of upload/download are only delivered
+        # to the guest wrapper, sessions report bytes once calls complete
+        listeners = getattr(self.guest, 'progress_listeners', None) if self.path else None
+        if isinstance(listeners, list):
+            listeners.append(self.event)
+        start = _clock()
+        self.started = start
+        try:
+            yield self
+        finally:
+            self.seconds += _clock() - start
+            self.started = None
+            if isinstance(listeners, list):
+                listeners.remove(self.event)
+            self.report(self.bytes, force=True)
+
+    def add(self, count):
+        self.bytes += count
+        self.report(self.bytes)
+
+    def event(self, position, total):
+        self.report(self.bytes + position, self.bytes + total)
+
+    def rate(self, count, seconds):
+        return round(count / 1048576.0 / seconds, 2) if seconds else None
+
+    def report(self, position, total=None, force=False):
+        now = _clock()
+        if not self.path or (not force and now - self.reported < self.INTERVAL) or position == self.position:
+            return
+        self.reported = now
+        self.position = position
+        seconds = self.seconds + (now - self.started if self.started else 0)
+        line = '{time} {position} bytes'.format(time=time.strftime('%Y-%m-%dT%H:%M:%S'), position=position)
+        if total:
+            line += ' of {total} ({percent}%)'.format(total=total, percent=int(position * 100 / total))
+        if self.rate(position, seconds) is not None:
+            line += ' {rate} MB/s'.format(rate=self.rate(position, seconds))
+        try:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+        except (IOError, OSError):
+            # Progress reporting is best effort
+            pass
+
+    def results(self):
+        return {
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 3),
+            'mb_per_second': self.rate(self.bytes, self.seconds),
+        }
+
+
+class _counted():
+    # File object counting bytes read or written through it
+    def __init__(self, fileobj, progress):
+        self.fileobj = fileobj
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.progress.add(len(data))
+        return data
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.progress.add(len(data))
+
+
+def _background(function, *args):
+    """Runs function in a daemon thread, returns the thread and a list collecting its exception."""
+
+    errors = []
+
+    def run():
+        try:
+            function(*args)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread, errors
+
+
+def _unblock(path, mode):
+    # Opens the other end of the FIFO so a worker blocked in open() returns
+    flags = os.O_NONBLOCK | (os.O_RDONLY if mode == 'wb' else os.O_WRONLY)
+    try:
+        os.close(os.open(path, flags))
+    except OSError:
+        pass
+
+
+@contextmanager
+def stream(worker, mode, progress=None):
+    """Yields path of a FIFO, worker is called with it opened in a thread.
+
+    libguestfs reads or writes the FIFO (tar_in/tar_out) while the worker
+    packs or extracts, archives are never stored on disk. Workers failing
+    are reraised once the libguestfs call succeeded.
+    """
+
+    directory = tempfile.mkdtemp(prefix='guestfs-stream-')
+    path = os.path.join(directory, 'stream')
+    os.mkfifo(path, 0o600)
+
+    def run():
+        with open(path, mode) as f:
+            worker(_counted(f, progress) if progress else f)
+
+    thread, errors = _background(run)
+    try:
+        yield path
+    finally:
+        # The libguestfs call may fail before or while using the FIFO
+        while thread.is_alive():
+            _unblock(path, mode)
+            thread.join(0.1)
+        shutil.rmtree(directory, ignore_errors=True)
+    if errors:
+        raise errors[0]
+
+
+def _drain(fileobj):
+    # tarfile stops at the end of archive marker, libguestfs fails when
+    # the remaining padding is not consumed
+    while fileobj.read(65536):
+        pass
+
+
+def _copy(source, target):
+    for block in iter(lambda: source.read(1048576), b''):
+        target.write(block)
+
+
+def _close(fileobj):
+    try:
+        fileobj.close()
+    except (IOError, OSError):
+        pass
+
+
+def _external(compression, decompress=False):
+    # Host compressor process, data is copied between it and the FIFO
+    command = COMPRESSORS[compression] + (['-d'] if decompress else [])
+    return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+
+def _finish(process, compression, feeder, errors, failed):
+    if failed and process.poll() is None:
+        process.kill()
+    feeder.join()
+    if process.wait() != 0 and not failed:
+        raise IOError('{} exited with code {}'.format(compression, process.returncode))
+    if errors and not failed:
+        raise errors[0]
+
+
+def tar_upload(guest, root, names, dest, compression='none', progress=None):
+    """Uploads names relative to local root into guest dest as a single tar stream."""
+
+    def feed(process):
+        try:
+            pack(root, names, process.stdin)
+        finally:
+            _close(process.stdin)
+
+    def worker(f):
+        if compression not in COMPRESSORS:
+            return pack(root, names, f, compression)
+        process = _external(compression)
+        feeder, errors = _background(feed, process)
+        failed = True
+        try:
+            _copy(process.stdout, f)
+            failed = False
+        finally:
+            _finish(process, compression, feeder, errors, failed)
+
+    progress = progress or transfer_progress()
+    guest.mkdir_p(dest)
+    with progress.measure():
+        with stream(worker, 'wb', progress) as path:
+            guest.tar_in(path, dest, **compress_options(compression))
+
+
+def tar_download(guest, src, dest, names=None, excludes=None, compression='none', progress=None):
+    """Downloads guest src into local dest as a single tar stream, returns extracted names."""
+
+    extracted = []
+
+    def feed(process, f):
+        try:
+            _copy(f, process.stdin)
+        finally:
+            _close(process.stdin)
+
+    def worker(f):
+        if compression not in COMPRESSORS:
+            extracted.extend(extract(f, dest, names))
+            return _drain(f)
+        process = _external(compression, decompress=True)
+        feeder, errors = _background(feed, process, f)
+        failed = True
+        try:
+            extracted.extend(extract(process.stdout, dest, names))
+            _drain(process.stdout)
+            failed = False
+        finally:
+            _finish(process, compression, feeder, errors, failed)
+
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    options = compress_options(compression)
+    if excludes:
+        options['excludes'] = excludes
+    progress = progress or transfer_progress()
+    with progress.measure():
+        with stream(worker, 'rb', progress) as path:
+            guest.tar_out(src, path, **options)
+    return extracted
+
+
+def sync_in(guest, src, dest, algorithm='md5', compression='none', progress=None):
+    """Uploads files under local 'src' which are missing or differ under guest 'dest'.
+
+    Returns sorted relative paths of uploaded entries.
+    """
+
+    files, others = local_tree(src)
+    local = local_signatures(src, files, algorithm)
+    remote, existing = remote_signatures(guest, dest, algorithm)
+    changed = [name for name in files if remote.get(name) != local[name]]
+    changed += [name for name in others if name not in existing]
+    if not changed:
+        return []
+
+    tar_upload(guest, src, sorted(changed), dest, compression, progress)
+    return sorted(changed)
+
+
+# Upper bound of exclude patterns passed to tar_out, libguestfs messages
+# are limited in size, larger trees are downloaded whole and filtered
+MAX_EXCLUDES = 10000
+
+
+def tar_pattern(name):
+    # GNU tar exclude patterns are globs, './' anchors them to the archive root
+    escaped = ''.join('[{}]'.format(c) if c in '*?[' else c for c in name.replace('\\', '\\\\'))
+    return './' + escaped
+
+
+def _within(root, path):
+    root = os.path.realpath(root)
+    path = os.path.realpath(path)
+    return path == root or path.startswith(root + os.path.sep)
+
+
+def extract(fileobj, dest, names=None):
+    """Extracts tar stream into dest, optionally only the given relative names.
+
+    Archives come from guest images which may not be trusted, members
+    escaping dest (absolute paths, '..', links outside of dest) and
+    device files are skipped.
+    """
+
+    extracted = []
+    # Members are validated below, the 'tar' filter keeps newer Python from warning
+    options = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+    tar = tarfile.open(fileobj=fileobj, mode='r|*')
+    try:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if name == '.':
+                continue
+            if os.path.isabs(name) or name.split(os.path.sep)[0] == '..':
+                continue
+            if names is not None and name not in names:
+                continue
+            if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+                continue
+            target = os.path.join(dest, name)
+            if not _within(dest, os.path.dirname(target)):
+                continue
+            if member.issym() and not _within(dest, os.path.join(os.path.dirname(target), member.linkname)):
+                continue
+            if member.islnk() and not _within(dest, os.path.join(dest, member.linkname)):
+                continue
+            member.name = name
+            if os.path.islink(target) or (os.path.exists(target) and not os.path.isdir(target)):
+                os.unlink(target)
+            tar.extract(member, dest, **options)
+            extracted.append(name)
+    finally:
+        tar.close()
+    return extracted
+
+
+def sync_out(guest, src, dest, algorithm='md5', compression='none', progress=None):
+    """Downloads files under guest 'src' which are missing or differ under local 'dest'.
+
+    Returns sorted relative paths of downloaded entries.
+    """
+
+    remote, entries = remote_signatures(guest, src, algorithm)
+    others = entries - set(remote)
+    present = [name for name in remote
+               if os.path.isfile(os.path.join(dest, name)) and not os.path.islink(os.path.join(dest, name))]
+    local = local_signatures(dest, present, algorithm)
+    changed = [name for name in remote if local.get(name) != remote[name]]
+    missing = [name for name in others if not os.path.lexists(os.path.join(dest, name))]
+    if not changed and not missing:
+        return []
+
+    unchanged = [name for name in remote if local.get(name) == remote[name]]
+    if len(unchanged) <= MAX_EXCLUDES:
+        excludes = [tar_pattern(name) for name in unchanged]
+    else:
+        excludes = None
+    # Directories and symlinks are always part of the archive
+    extracted = tar_download(guest, src, dest, set(changed) | others, excludes, compression, progress)
+    return sorted(set(changed + missing).intersection(extracted))
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = """
+module: guestfs_batch
+short_description: Perform several operations on guest image using a single appliance
+version_added: '2.8'
+description:
+  - Performs an ordered list of operations on guest image using a single appliance launch
+  - Execution stops at the first failed step
+options:
+  steps:
+    required: True
+    description:
+      - List of operations to perform. Each element is a dictionary with a single key naming the operation
+      - "'shell' and 'command' accept a string, same as in 'guestfs_command'"
+      - "'upload' accepts 'src', 'dest', 'files', 'recursive', 'incremental', 'compression' and 'checksum_algorithm', same as in 'guestfs_copy_in'"
+      - "'download' accepts 'src', 'dest', 'files', 'recursive', 'incremental', 'compression' and 'checksum_algorithm', same as in 'guestfs_copy_out'"
+      - "'package' accepts 'name', 'state', 'packages', 'cache_valid_time', 'local_repo', 'download_cache', 'list', 'match', 'inventory' and 'inventory_file', same as in 'guestfs_package'"
+      - "A 'package' step with 'local_repo' disables appliance network for the whole batch"
+      - "'user' accepts 'name', 'password' and 'state', same as in 'guestfs_user', 'password' is not logged"
+  readonly:
+    required: False
+    description: Whether to add guest disk image read-only, changes made inside appliance are discarded, defaults to True when all steps are downloads or package listings
+extends_documentation_fragment:
+  - vkhitrin.libguestfs.libguestfs
+notes:
+  - stderr output is not available in libguestfs
+requirements:
+  - "libguestfs"
+  - "libguestfs-devel"
+  - "python >= 2.7.5 || python >= 3.4"
+author:
+  - Vadim Khitrin (@vkhitrin)
+"""
+
+EXAMPLES = """
+- name: Customize guest image in a single appliance launch
+  guestfs_batch:
+    image: /tmp/rhel7-5.qcow2
+    steps:
+      - package:
+          name:
+            - vim
+            - nc
+          state: present
+      - upload:
+          src: /tmp/motd
+          dest: /etc/motd
+      - user:
+          name: test_user
+          password: test_password
+          state: present
+      - shell: 'systemctl enable sshd'
+      - download:
+          src: /var/log/dnf.log
+          dest: /tmp/
+"""
+
+RETURN = """
+msg:
+  type: string
+  when: failure
+  description: Contains the error message of the failed step (may include python exceptions)
+  example: "Step 1 (upload) failed: Source path /tmp/motd not found"
+
+results:
+  type: array
+  when: always
+  description: Results of executed steps, each element contains the results of the matching module
+  example: [
+      {
+          "step": 0,
+          "operation": "shell",
+          "changed": true,
+          "failed": false,
+          "stdout": "hello world",
+          "stdout_lines": ["hello world"]
+      }
+  ]
+
+lock_wait:
+  type: float
+  when: image_lock is enabled
+  description: Seconds spent waiting for the lock on guest disk image
+  example: 0.0
+
+images:
+  type: list
+  when: "'image' is a list or a glob pattern"
+  description: Results of each image, same as returned for a single image, with the image path as 'image'
+  example: [
+      {"image": "/tmp/web-1.qcow2", "changed": true, "failed": false},
+      {"image": "/tmp/web-2.qcow2", "changed": false, "failed": true, "msg": "Could not find image"}
+  ]
+
+timings:
+  type: dict
+  when: profile is enabled
+  description: Duration in seconds of each phase
+  example: {
+      "launch": 2.481,
+      "inspect": 0.912,
+      "mount": 0.103,
+      "operation": 0.052,
+      "umount_sync": 0.087,
+      "shutdown": 0.215
+  }
+"""
+
+from ansible.module_utils.basic import AnsibleModule
+from ..module_utils.libguestfs import guest_argument_spec, run_operation
+from ..module_utils.operations import OPERATIONS, readonly_step, run_steps, step_params, step_sources
+
+
+def step_options():
+    # Steps are validated by step_params, suboptions declare user passwords
+    # as no_log so they are kept out of the invocation, syslog and verbose output
+    options = dict((operation, dict(required=False, type='raw')) for operation in OPERATIONS)
+    options['user'] = dict(required=False, type='dict', options=dict(
+        name=dict(required=False, type='str'),
+        password=dict(required=False, type='str', no_log=True),
+        state=dict(required=False, type='str'),
+    ))
+    return options
+
+
+def main():
+
+    module = AnsibleModule(
+        argument_spec=guest_argument_spec(
+            steps=dict(required=True, type='list', elements='dict', options=step_options()),
+        ),
+        supports_check_mode=False
+    )
+
+    # Validate every step before launching appliance
+    steps = []
+    for index, step in enumerate(module.params['steps']):
+        # Operations missing from a step are set to None by the suboptions
+        step = dict((operation, options) for operation, options in step.items() if options is not None)
+        try:
+            steps.append(step_params(step))
+        except ValueError as e:
+            module.fail_json(msg='Step {}: {}'.format(index, str(e)))
+
+    results, err = run_operation(module, lambda instance, module: run_steps(instance, module, steps),
+                                 readonly=all(readonly_step(*step) for step in steps), sources=step_sources(steps))
+
+    if err:
+        module.fail_json(**results)
+    module.exit_json(**results)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,30 +14,14 @@ version_added: '2.8'
 description:
   - Execute commands on guest images
 options:
-  image:
-    required: True
-    description: Image path on filesystem
   shell:
     required: False
     description: List of commands to run in shell (commands are invoked from /usr/bin/sh), shell and command are mutually exclusive
   command:
     required: False
     description: List of commands to run directly from binaries, shell and command are mutually exclusive
-  automount:
-    required: False
-    description: Whether to perform auto mount of mountpoints inside guest disk image
-    default: True
-  mounts:
-    required: False
-    description: "List of mounts that will be attempted. Each element is a dictionary {'/path/to/device': '/path/to/mountpoint'}"
-  network:
-    required: False
-    description: Whether to enable network for appliance
-    default: True
-  selinux_relabel:
-    required: False
-    description: Whether to perform SELinux context relabeling
-    default: False
+extends_documentation_fragment:
+  - vkhitrin.libguestfs.libguestfs
 notes:
   - stderr output is not available in libguestfs
 requirements:
@@ -59,6 +43,12 @@ EXAMPLES = """
     image: /tmp/rhel7-5.qcow2
     command: 'systemctl reboot'
     network: False
+
+- name: Executes a shell command on every image, four at a time
+  guestfs_command:
+    image: /var/lib/images/web-*.qcow2
+    max_workers: 4
+    shell: 'dnf -y update'
 """
 
 RETURN = """
@@ -82,49 +72,39 @@ stdout_lines:
       "hello",
       "world"
   ]
-"""
-
-from ansible.module_utils.basic import AnsibleModule
-from ..module_utils.libguestfs import guest
 
-import re
+lock_wait:
+  type: float
+  when: image_lock is enabled
+  description: Seconds spent waiting for the lock on guest disk image
+  example: 0.0
 
+images:
+  type: list
+  when: "'image' is a list or a glob pattern"
+  description: Results of each image, same as returned for a single image, with the image path as 'image'
+  example: [
+      {"image": "/tmp/web-1.qcow2", "changed": true, "failed": false},
+      {"image": "/tmp/web-2.qcow2", "changed": false, "failed": true, "msg": "Could not find image"}
+  ]
 
-def execute(guest, module):
-
-    results = {
-        'changed': False,
-        'failed': False,
-    }
-    err = False
-
-    # Create a command variable
-    if module.params['shell']:
-        cmd = module.params['shell']
-    elif module.params['command']:
-        cmd = module.params['command']
-
-    try:
-        if module.params['shell']:
-            result = guest.sh(cmd)
-        elif module.params['command']:
-            # Split sentence into words using regular expressions
-            cmd_args = re.findall(r'([^\s]+)', cmd)
-            result = guest.command(cmd_args)
-    except Exception as e:
-        err = True
-        results['failed'] = True
-        error_message = str(e)
-        if error_message in ['command: ', 'sh: ']:
-            error_message = 'command has returned stderr to shell but guestfs does not return it'
-        results['msg'] = error_message
-
-    if not err:
-        results['changed'] = True
-        results['stdout'] = result.rstrip('\n')
-        results['stdout_lines'] = results['stdout'].split('\n')
+timings:
+  type: dict
+  when: profile is enabled
+  description: Duration in seconds of each phase
+  example: {
+      "launch": 2.481,
+      "inspect": 0.912,
+      "mount": 0.103,
+      "operation": 0.052,
+      "umount_sync": 0.087,
+      "shutdown": 0.215
+  }
+"""
 
-    return results, err
+from ansible.module_utils.basic import AnsibleModule
+from ..module_utils.libguestfs import guest_argument_spec, run_operation
+from ..module_utils.operations import execute
 
 
 def main():
@@ -132,12 +112,7 @@ def main():
     mutual_exclusive_args = [['command', 'shell']]
     required_one_of_args = [['command', 'shell']]
     module = AnsibleModule(
-        argument_spec=dict(
-            image=dict(required=True, type='str'),
-            automount=dict(required=False, type='bool', default=True),
-            mounts=dict(required=False,  type='list', elements='dict'),
-            network=dict(required=False, type='bool', default=True),
-            selinux_relabel=dict(required=False, type='bool', default=False),
+        argument_spec=guest_argument_spec(
             command=dict(required=False, type='str'),
             shell=dict(required=False, type='str'),
             debug=dict(required=False, type='bool', default=False),
@@ -147,10 +122,7 @@ def main():
         supports_check_mode=False
     )
 
-    g = guest(module)
-    instance = g.bootstrap()
-    results, err = execute(instance, module)
-    g.close()
+    results, err = run_operation(module, execute, sources=[])
 
     if err:
         module.fail_json(**results)
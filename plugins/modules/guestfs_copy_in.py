@@ -14,32 +14,58 @@ version_added: '2.8'
 description:
   - Uploads files to guest image
 options:
-  image:
-    required: True
-    description: Image path on filesystem
   src:
-    required: True
-    description: Source file path on filesystem
+    required: False
+    description: Source file path on filesystem, may be a glob pattern in which case matches are uploaded into 'dest' directory. Required unless 'files' is provided
   dest:
-    required: True
-    description: Destination file path in guest image
+    required: False
+    description: Destination file path in guest image. Required with 'src'
+  files:
+    required: False
+    description:
+      - List of files to upload using a single appliance launch, mutually exclusive with 'src'
+      - Each element is a dictionary with 'src' and 'dest' (same as above), optional 'mode' (for example '0644') and optional 'owner' ('user' or 'user:group', resolved using guest image's databases)
+      - Files are only uploaded when their checksums differ, 'recursive', 'incremental' and 'compression' apply to all elements
   recursive:
     required: False
     description: Copies nested directories from a directory on guest disk image
-  automount:
+  incremental:
     required: False
-    description: Whether to perform auto mount of mountpoints inside guest disk image
-    default: True
-  mounts:
+    description:
+      - When copying a directory recursively, only upload files which are missing or differ in guest disk image
+      - Checksums of guest files are retrieved in a single call and changed files are uploaded as a single archive
+      - Files which only exist in guest disk image are kept
+    default: False
+  compression:
     required: False
-    description: "List of mounts that will be attempted. Each element is a dictionary {'/path/to/device': '/path/to/mountpoint'}"
-  selinux_relabel:
+    description:
+      - When copying a directory recursively, upload it as a single tar stream compressed with this method instead of copying it file by file
+      - The stream is passed through a pipe and never stored on disk, 'zstd' requires the 'zstd' binary on host and support in the appliance
+      - Also applies to 'incremental' transfers
+    default: none
+    choices:
+    - none
+    - gzip
+    - xz
+    - zstd
+  checksum_algorithm:
     required: False
-    description: Whether to perform SELinux context relabeling
-  network:
+    description:
+      - Algorithm used to compare source and destination files, including 'incremental' transfers
+      - "'quick' compares size and modification time without reading files, copied files get source's modification time"
+    default: md5
+    choices:
+    - md5
+    - sha1
+    - sha256
+    - quick
+  progress_file:
     required: False
-    description: Whether to enable network for appliance
-    default: True
+    description:
+      - Path of a file on filesystem to which transfer progress (bytes, percentage and MB/s) is appended about every second, it can be followed with 'tail -f' during long transfers
+      - Percentage is reported for single files using libguestfs progress events, which are not available when using 'session'
+extends_documentation_fragment:
+  - vkhitrin.libguestfs.libguestfs
 notes: []
 requirements:
   - "libguestfs"
@@ -68,6 +94,35 @@ EXAMPLES = """
     src: '/tmp/logs/'
     dest: '/tmp/'
     recursive: True
+
+- name: Upload only changed files of a directory to guest disk image
+  guestfs_copy_in:
+    image: /tmp/rhel7-5.qcow2
+    src: '/etc/myapp'
+    dest: '/etc/'
+    recursive: True
+    incremental: True
+
+- name: Upload a large directory of small files as a compressed stream
+  guestfs_copy_in:
+    image: /tmp/rhel7-5.qcow2
+    src: '/srv/www'
+    dest: '/srv/'
+    recursive: True
+    compression: gzip
+
+- name: Upload several files using a single appliance launch
+  guestfs_copy_in:
+    image: /tmp/rhel7-5.qcow2
+    files:
+      - src: '/srv/configs/sshd_config'
+        dest: '/etc/ssh/sshd_config'
+        mode: '0600'
+        owner: 'root:root'
+      - src: '/srv/configs/motd'
+        dest: '/etc/motd'
+      - src: '/srv/configs/yum.repos.d/*.repo'
+        dest: '/etc/yum.repos.d/'
 """
 
 RETURN = """
@@ -89,110 +144,109 @@ dest:
   description: dest path of file(s) on guest image
   example: "/tmp/RESULT_ANS.log"
 
+uploaded:
+  type: list
+  when: incremental upload of a directory
+  description: Paths relative to dest of uploaded files and directories
+  example: [
+      "conf.d/app.conf"
+  ]
+
+results:
+  type: list
+  when: "'files' is provided or 'src' is a glob pattern"
+  description: Results of each copied file, same as returned for a single file
+  example: [
+      {
+          "changed": true,
+          "failed": false,
+          "src": "/etc/os-release",
+          "dest": "/tmp/facts/os-release",
+          "md5sum": "d6fe77f000341b5f9a952e744f34901a"
+      }
+  ]
+
+checksum:
+  type: string
+  when: successful copy of a single file using a checksum algorithm
+  description: Checksum of source file using 'checksum_algorithm'
+  example: "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+
 md5:
   type: string
   when: success upload file
   description: displays md5 checksum of file
   "debug": "d6fe77f000341b5f9a952e744f34901a"
+
+transfer:
+  type: dict
+  when: data was transferred
+  description: Bytes passed to or from the appliance (compressed size for compressed streams), seconds spent transferring them and throughput
+  example: {
+      "bytes": 524288000,
+      "seconds": 6.148,
+      "mb_per_second": 81.33
+  }
+
+lock_wait:
+  type: float
+  when: image_lock is enabled
+  description: Seconds spent waiting for the lock on guest disk image
+  example: 0.0
+
+images:
+  type: list
+  when: "'image' is a list or a glob pattern"
+  description: Results of each image, same as returned for a single image, with the image path as 'image'
+  example: [
+      {"image": "/tmp/web-1.qcow2", "changed": true, "failed": false},
+      {"image": "/tmp/web-2.qcow2", "changed": false, "failed": true, "msg": "Could not find image"}
+  ]
+
+timings:
+  type: dict
+  when: profile is enabled
+  description: Duration in seconds of each phase
+  example: {
+      "launch": 2.481,
+      "inspect": 0.912,
+      "mount": 0.103,
+      "operation": 0.052,
+      "umount_sync": 0.087,
+      "shutdown": 0.215
+  }
 """
 
 from ansible.module_utils.basic import AnsibleModule
-from ..module_utils.libguestfs import guest
-
-import os
-
-
-def upload(guest, module):
-
-    err = False
-    results = {
-        'changed': False,
-        'failed': False
-    }
-    md5sum_src = None
-    md5sum_dest = None
-    src = module.params['src']
-    dest = module.params['dest']
-
-    if not os.path.exists(src):
-        err = True
-        results['failed'] = True
-        results['msg'] = 'Source path {path} not found'.format(path=src)
-
-    elif not os.access(src, os.R_OK):
-        err = True
-        results['failed'] = True
-        results['msg'] = 'Source path {path} not accessable'.format(path=src)
-
-    if not err:
-        try:
-            # Check if source path is a file and not a directory/symlink
-            if not os.path.isfile(src) and not module.params['recursive']:
-                err = True
-                results['msg'] = "Source file is either directory or symlink, if it's a directory use 'recursive' argument"
-            else:
-                if module.params['recursive']:
-                    guest.copy_in(src, dest)
-                    if not src.endswith(os.path.sep):
-                        dest = dest + os.path.basename(src)
-                else:
-                    md5sum_src = module.md5(src)
-                    if dest.endswith(os.path.sep):
-                        dest = dest + os.path.basename(src)
-                    # Check if destination file exists on guest image
-                    if guest.is_file(dest):
-                        md5sum_dest = guest.checksum("md5", dest)
-                    # If md5sum of source file and dest file are different, upload file to guest
-                    if md5sum_src != md5sum_dest:
-                        results['changed'] = True
-                        guest.upload(src, dest)
-
-        except Exception as e:
-            err = True
-            results['failed'] = True
-            results['msg'] = str(e)
-
-        if md5sum_src:
-            md5sum_dest = guest.checksum("md5", dest)
-
-        if not err:
-            results['src'] = src
-            '''
-            Not using 'dest' in results due to
-            'ansible.module_utils.basic' containing the method
-            'add_path_info' which attempts to retrieve info
-            regarding the path which does not exist on target host
-            (Fixed in Ansible 2.8,
-            commit: cc9c72d6f845710b24e952670b534a57f6948513)
-            '''
-            results['dest'] = dest
-
-            if md5sum_src and md5sum_dest:
-                results['md5'] = md5sum_src
-
-    return results, err
+from ..module_utils.libguestfs import guest_argument_spec, run_operation
+from ..module_utils.operations import upload_files, upload_sources
 
 
 def main():
 
     module = AnsibleModule(
-        argument_spec=dict(
-            image=dict(required=True, type='str'),
-            src=dict(required=True, type='path'),
-            dest=dict(required=True, type='path'),
+        argument_spec=guest_argument_spec(
+            src=dict(required=False, type='path'),
+            dest=dict(required=False, type='path'),
+            files=dict(required=False, type='list', elements='dict', options=dict(
+                src=dict(required=True, type='path'),
+                dest=dict(required=True, type='path'),
+                mode=dict(required=False, type='raw'),
+                owner=dict(required=False, type='str'),
+            )),
             recursive=dict(required=False, type='bool', default=False),
-            automount=dict(required=False, type='bool', default=True),
-            mounts=dict(required=False,  type='list', elements='dict'),
-            network=dict(required=False, type='bool', default=True),
-            selinux_relabel=dict(required=False, type='bool', default=False),
+            incremental=dict(required=False, type='bool', default=False),
+            compression=dict(required=False, type='str', default='none', choices=['none', 'gzip', 'xz', 'zstd']),
+            checksum_algorithm=dict(required=False, type='str', default='md5', choices=['md5', 'sha1', 'sha256', 'quick']),
+            progress_file=dict(required=False, type='path'),
         ),
+        required_one_of=[['src', 'files']],
+        mutually_exclusive=[['src', 'files']],
+        required_together=[['src', 'dest']],
         supports_check_mode=False
     )
 
-    g = guest(module)
-    instance = g.bootstrap()
-    results, err = upload(instance, module)
-    g.close()
+    results, err = run_operation(module, upload_files, sources=upload_sources(module.params))
 
     if err:
         module.fail_json(**results)
@@ -14,34 +14,63 @@ version_added: '2.8'
 description:
   - Fetch files from guest image
 options:
-  image:
-    required: True
-    description: Image path on filesystem
   src:
-    required: True
-    description: Source file path on guest image
+    required: False
+    description: Source file path on guest image, may be a glob pattern in which case matches are downloaded into 'dest' directory. Required unless 'files' is provided
   dest:
-    required: True
-    description: Destination file path on filesystem
+    required: False
+    description: Destination file path on filesystem. Required with 'src'
+  files:
+    required: False
+    description:
+      - List of files to download using a single appliance launch, mutually exclusive with 'src'
+      - Each element is a dictionary with 'src' and 'dest' (same as above), optional 'mode' (for example '0644') and optional 'owner' ('user' or 'user:group') of downloaded file
+      - Files are only downloaded when their checksums differ, 'recursive', 'incremental' and 'compression' apply to all elements
   recursive:
     required: False
     description: Copies nested directories from a directory on guest disk image
     default: False
-  automount:
+  incremental:
     required: False
-    description: Whether to perform auto mount of mountpoints inside guest disk image
-    default: True
-  mounts:
+    description:
+      - When copying a directory recursively, only download files which are missing or differ on filesystem
+      - Checksums of guest files are retrieved in a single call, local files are hashed concurrently and changed files are downloaded as a single archive
+      - Files which only exist on filesystem are kept
+    default: False
+  compression:
     required: False
-    description: "List of mounts that will be attempted. Each element is a dictionary {'/path/to/device': '/path/to/mountpoint'}"
-  network:
+    description:
+      - When copying a directory recursively, download it as a single tar stream compressed with this method instead of copying it file by file
+      - The stream is passed through a pipe and never stored on disk, 'zstd' requires the 'zstd' binary on host and support in the appliance
+      - Also applies to 'incremental' transfers
+    default: none
+    choices:
+    - none
+    - gzip
+    - xz
+    - zstd
+  checksum_algorithm:
     required: False
-    description: Whether to enable network for appliance
-    default: True
-  selinux_relabel:
+    description:
+      - Algorithm used to compare source and destination files, including 'incremental' transfers
+      - "'quick' compares size and modification time without reading files, copied files get source's modification time"
+    default: md5
+    choices:
+    - md5
+    - sha1
+    - sha256
+    - quick
+  progress_file:
     required: False
-    description: Whether to perform SELinux context relabeling
-    default: False
+    description:
+      - Path of a file on filesystem to which transfer progress (bytes, percentage and MB/s) is appended about every second, it can be followed with 'tail -f' during long transfers
+      - Percentage is reported for single files using libguestfs progress events, which are not available when using 'session'
+  readonly:
+    required: False
+    description: Whether to add guest disk image read-only, changes made inside appliance are discarded
+    default: True
+extends_documentation_fragment:
+  - vkhitrin.libguestfs.libguestfs
 notes:
   - If your Ansible host is not your Ansible Controller host, use the module 'fetch' or 'synchronize' to retrieve remote files
 requirements:
@@ -71,6 +100,32 @@ EXAMPLES = """
     src: '/tmp/logs/'
     dest: '/tmp/'
     recursive: True
+
+- name: Download only changed files of a directory from guest disk image
+  guestfs_copy_out:
+    image: /tmp/rhel7-5.qcow2
+    src: '/var/log/myapp'
+    dest: '/tmp/'
+    recursive: True
+    incremental: True
+
+- name: Download a large directory as a compressed stream
+  guestfs_copy_out:
+    image: /tmp/rhel7-5.qcow2
+    src: '/var/lib/myapp'
+    dest: '/tmp/'
+    recursive: True
+    compression: zstd
+
+- name: Download several files using a single appliance launch
+  guestfs_copy_out:
+    image: /tmp/rhel7-5.qcow2
+    files:
+      - src: '/etc/os-release'
+        dest: '/tmp/facts/os-release'
+        mode: '0644'
+      - src: '/var/log/*.log'
+        dest: '/tmp/logs/'
 """
 
 RETURN = """
@@ -92,86 +147,110 @@ dest:
   description: dest path of file(s) to download to host
   example: "/tmp/RESULT_ANS.log"
 
+downloaded:
+  type: list
+  when: incremental download of a directory
+  description: Paths relative to dest of downloaded files, directories and symlinks
+  example: [
+      "myapp/error.log"
+  ]
+
+results:
+  type: list
+  when: "'files' is provided or 'src' is a glob pattern"
+  description: Results of each copied file, same as returned for a single file
+  example: [
+      {
+          "changed": true,
+          "failed": false,
+          "src": "/etc/os-release",
+          "dest": "/tmp/facts/os-release",
+          "md5sum": "d6fe77f000341b5f9a952e744f34901a"
+      }
+  ]
+
+checksum:
+  type: string
+  when: successful copy of a single file using a checksum algorithm
+  description: Checksum of source file using 'checksum_algorithm'
+  example: "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+
 md5:
   type: string
   when: successful download of a single file
   description: displays md5 checksum of single file
   "example": "d6fe77f000341b5f9a952e744f34901a"
+
+transfer:
+  type: dict
+  when: data was transferred
+  description: Bytes passed to or from the appliance (compressed size for compressed streams), seconds spent transferring them and throughput
+  example: {
+      "bytes": 524288000,
+      "seconds": 6.148,
+      "mb_per_second": 81.33
+  }
+
+lock_wait:
+  type: float
+  when: image_lock is enabled
+  description: Seconds spent waiting for the lock on guest disk image
+  example: 0.0
+
+images:
+  type: list
+  when: "'image' is a list or a glob pattern"
+  description: Results of each image, same as returned for a single image, with the image path as 'image'
+  example: [
+      {"image": "/tmp/web-1.qcow2", "changed": true, "failed": false},
+      {"image": "/tmp/web-2.qcow2", "changed": false, "failed": true, "msg": "Could not find image"}
+  ]
+
+timings:
+  type: dict
+  when: profile is enabled
+  description: Duration in seconds of each phase
+  example: {
+      "launch": 2.481,
+      "inspect": 0.912,
+      "mount": 0.103,
+      "operation": 0.052,
+      "umount_sync": 0.087,
+      "shutdown": 0.215
+  }
 """
 
 from ansible.module_utils.basic import AnsibleModule
-from ..module_utils.libguestfs import guest
-
-import os
-
-
-def download(guest, module):
-
-    err = False
-    results = {
-        'changed': False,
-        'failed': False,
-        'src': module.params['src'],
-    }
-    md5sum_src = None
-    md5sum_dest = None
-    src = module.params['src']
-    dest = module.params['dest']
-
-    try:
-        # Check if source path is a file and not a directory/symlink
-        if not guest.is_file(src) and not module.params['recursive']:
-            err = True
-            results['msg'] = "Source file is either directory or symlink, if it's a directory use 'recursive' argument"
-        else:
-            if module.params['recursive']:
-                if not src.endswith(os.path.sep):
-                    dest = dest + os.path.basename(src)
-                guest.copy_out(src, dest)
-            else:
-                md5sum_src = guest.checksum("md5", src)
-                if dest.endswith(os.path.sep):
-                    dest = dest + os.path.basename(src)
-                # Check if destination file exists on host
-                if os.path.isfile(dest):
-                    md5sum_dest = module.md5(dest)
-                # If md5sum of source file and dest file are different, download file from guest
-                if md5sum_src != md5sum_dest:
-                    results['changed'] = True
-                    guest.download(src, dest)
-
-    except Exception as e:
-        err = True
-        results['failed'] = True
-        results['msg'] = str(e)
-
-    if not err:
-        results['md5sum'] = md5sum_src
-        results['dest'] = dest
-
-    return results, err
+from ..module_utils.libguestfs import guest_argument_spec, run_operation
+from ..module_utils.operations import download_files
 
 
 def main():
 
     module = AnsibleModule(
-        argument_spec=dict(
-            image=dict(required=True, type='str'),
-            src=dict(required=True, type='path'),
-            dest=dict(required=True, type='path'),
+        argument_spec=guest_argument_spec(
+            src=dict(required=False, type='path'),
+            dest=dict(required=False, type='path'),
+            files=dict(required=False, type='list', elements='dict', options=dict(
+                src=dict(required=True, type='path'),
+                dest=dict(required=True, type='path'),
+                mode=dict(required=False, type='raw'),
+                owner=dict(required=False, type='str'),
+            )),
             recursive=dict(required=False, type='bool', default=False),
-            automount=dict(required=False, type='bool', default=True),
-            mounts=dict(required=False,  type='list', elements='dict'),
-            network=dict(required=False, type='bool', default=True),
-            selinux_relabel=dict(required=False, type='bool', default=False),
+            incremental=dict(required=False, type='bool', default=False),
+            compression=dict(required=False, type='str', default='none', choices=['none', 'gzip', 'xz', 'zstd']),
+            checksum_algorithm=dict(required=False, type='str', default='md5', choices=['md5', 'sha1', 'sha256', 'quick']),
+            progress_file=dict(required=False, type='path'),
+            readonly=dict(required=False, type='bool', default=True),
         ),
+        required_one_of=[['src', 'files']],
+        mutually_exclusive=[['src', 'files']],
+        required_together=[['src', 'dest']],
         supports_check_mode=False
     )
 
-    g = guest(module)
-    instance = g.bootstrap()
-    results, err = download(instance, module)
-    g.close()
+    results, err = run_operation(module, download_files)
 
     if err:
         module.fail_json(**results)
@@ -14,38 +14,71 @@ version_added: '2.8'
 description:
   - Manage packages on guest image
 options:
-  image:
-    required: True
-    description: Image path on filesystem
   name:
     required: False
-    description: List of packages to manipulate, name and list are mutually exclusive
+    description: List of packages to manipulate, name, packages and list are mutually exclusive
   state:
-    required: True
-    description: action to be performed
+    required: False
+    description: Action to be performed, required with name
     choices:
     - present
     - absent
+    - latest
+  packages:
+    required: False
+    description:
+      - List of packages with their state, each element is a dictionary with 'name' (a package or a list of packages) and optional 'state' (present, absent or latest, defaults to present)
+      - Packages are resolved into a single package manager transaction per state, removals first
+  cache_valid_time:
+    required: False
+    description:
+      - Seconds the apt package lists of guest are considered valid, lists refreshed more recently are not refreshed again
+      - Lists are refreshed at most once per appliance (batch or session) regardless
+    default: 0
+  local_repo:
+    required: False
+    description:
+      - Host directory of packages (RPMs or DEBs) or of a repository to install packages from, instead of the repositories configured in guest
+      - The directory is uploaded to guest in a single stream and configured as a temporary repository, which is removed afterwards
+      - When it has no repository index (repodata or Packages), one is built inside guest with createrepo or apt-ftparchive/dpkg-scanpackages
+      - Appliance network is disabled
+  download_cache:
+    required: False
+    description:
+      - Whether to keep packages downloaded by the package manager in 'cache_dir' on host, shared by guest disk images of the same distribution, release and architecture
+      - The guest download cache (/var/cache/dnf, /var/cache/yum or /var/cache/apt/archives) is mounted from a sparse scratch drive seeded with packages downloaded by previous runs, new downloads are saved to host afterwards, so downloads never take space in the guest disk image
+      - Seeding copies the whole host cache of the distribution into the appliance on every run, which takes longer as the cache grows, prune 'cache_dir' when it gets large
+      - With 'session', no scratch drive is attached, packages are downloaded into the guest disk image and only saved to host, the clusters they took stay allocated in the image after they are removed
+    default: False
   list:
     required: False
     description: String to match when querying installed packages, to display all insert '*', name and list are mutually exclusive
-  automount:
+  match:
     required: False
-    description: Whether to perform auto mount of mountpoints inside guest disk image
-    default: True
-  mounts:
+    description: How 'list' is matched against package names, a regular expression matched from the start of names, the exact name or a prefix of names
+    choices:
+    - regex
+    - exact
+    - prefix
+    default: regex
+  inventory:
     required: False
-    description: "List of mounts that will be attempted. Each element is a dictionary {'/path/to/device': '/path/to/mountpoint'}"
-  network:
+    description: Whether to return listed packages as dictionaries with 'name', 'epoch', 'version', 'release', 'arch' and 'source' (source package) instead of 'name-version-release-arch' strings
+    default: False
+  inventory_file:
     required: False
-    description: Whether to enable network for appliance
-    default: True
-  selinux_relabel:
+    description:
+      - Local JSON file the full package inventory of guest disk image is written to when listing packages, along with the image identity
+      - While guest disk image is unchanged, packages are listed from the file without launching an appliance
+      - "'{image}' in the path is replaced by the image file name, which keeps inventories apart when 'image' matches several images"
+  readonly:
     required: False
-    description: Whether to perform SELinux context relabeling
-    default: False
+    description: Whether to add guest disk image read-only, changes made inside appliance are discarded, defaults to True when using list
+extends_documentation_fragment:
+  - vkhitrin.libguestfs.libguestfs
 notes:
   - Currently only guest images with dnf,yum and apt package managers are supported
+  - Installed packages are listed before running the package manager, which is skipped for packages already present (compared by package name, optionally with architecture), versioned names, globs and paths are always passed to it, as well as packages to remove since a name may be provided by a package of another name
 requirements:
   - "libguestfs"
   - "libguestfs-devel"
@@ -85,6 +118,33 @@ EXAMPLES = """
       - telnet
     state: absent
 
+- name: Installs, upgrades and removes packages in one run
+  guestfs_package:
+    image: /tmp/debian11.qcow2
+    packages:
+      - name: [vim, curl]
+      - name: openssl
+        state: latest
+      - name: telnet
+        state: absent
+    cache_valid_time: 3600
+
+- name: Installs packages from a host directory of RPMs without network
+  guestfs_package:
+    image: /tmp/rhel8.qcow2
+    name:
+      - vim-enhanced
+      - tmux
+    state: present
+    local_repo: /srv/mirror/rhel8-extras
+
+- name: Installs packages reusing packages downloaded for other images
+  guestfs_package:
+    image: /tmp/fedora34.qcow2
+    name: httpd
+    state: present
+    download_cache: True
+
 - name: List all packages containing string 'yum'
   guestfs_package:
     image: /tmp/rhel7-5.qcow2
@@ -94,6 +154,14 @@ EXAMPLES = """
   guestfs_package:
     image: /tmp/rhel7-5.qcow2
     list: '*'
+
+- name: Get structured details of packages named 'openssl*' of several images, keeping their inventories
+  guestfs_package:
+    image: /var/lib/images/*.qcow2
+    list: openssl
+    match: prefix
+    inventory: True
+    inventory_file: /var/cache/inventories/{image}.json
 """
 
 RETURN = """
@@ -106,11 +174,19 @@ msg:
 results:
   type: array
   when: success
-  description: Contains the module successful execution results
+  description: Contains the module successful execution results, listed packages are dictionaries when 'inventory' is enabled
   example: [
       "2:vim-enhanced-7.4.160-4.el7.x86_64 is present"
   ]
 
+cached_downloads:
+  type: list
+  when: download_cache is enabled and packages were installed
+  description: Files of the guest download cache saved to host by this run
+  example: [
+      "fedora-6d3ae9f3f9ec1cd8/packages/httpd-2.4.48-1.fc34.x86_64.rpm"
+  ]
+
 log:
   type: array
   when: available and invoked
@@ -119,134 +195,65 @@ log:
       "Loaded plugins: search-disabled-repos",
       "No Packages marked for removal"
   ]
-"""
-
-from ansible.module_utils.basic import AnsibleModule
-from ..module_utils.libguestfs import guest
-
-import re
-
-PACKAGE_MANAGERS = {
-    'dnf': {'present': 'dnf -y install', 'absent': 'dnf -y remove'},
-    'yum': {'present': 'yum -y install', 'absent': 'yum -y remove'},
-    'apt': {'present': 'apt-get -q -y -o Dpkg::Options::=--force-confnew update; apt-get -y install', 'absent': 'apt-get -y remove'}
-}
-
-
-def packages(guest, module):
-
-    state = module.params['state']
-    results = {
-        'changed': False,
-        'failed': False
-    }
-    # Use set to be converted into list since yum/dnf querying could contain same value multiple times
-    response = set()
-    err = False
 
-    if module.params['name']:
-        packages_string = ' '.join(module.params['name'])
-        for mount in guest.mounts():
-            package_manager = guest.inspect_get_package_management(mount)
-            # If libguest managed to find package manager, quit loop
-            if package_manager != 'unknown' and package_manager:
-                break
+lock_wait:
+  type: float
+  when: image_lock is enabled
+  description: Seconds spent waiting for the lock on guest disk image
+  example: 0.0
 
-        if package_manager in PACKAGE_MANAGERS:
-            try:
-                result = guest.sh_lines('{command} {packages}'.format(command=PACKAGE_MANAGERS[package_manager][state],
-                                                                      packages=packages_string))
-            except Exception as e:
-                err = True
-                results['failed'] = True
-                results['msg'] = str(e)
-
-            if package_manager in ['yum', 'dnf'] and not err:
-                results['log'] = '\n'.join(result)
-                for line in result:
-                    for package in module.params['name']:
-                        if package in line:
-                            if 'Verifying' in line:
-                                results['changed'] = True
-                                # Split sentence into words using regular expressions
-                                invoked_package = re.findall(r'([^\s]+)', line)[2]
-                                response.add('{package} is {state}'.format(package=invoked_package, state=state))
-                            elif 'already installed' in line:
-                                response.add(line.replace('Package ', ''))
-                            elif 'No package {package} available.'.format(package=package) in line:
-                                results['failed'] = True
-                                results['msg'] = line
-
-                        if 'No Packages marked for removal' in line:
-                            response.add(line)
-
-            elif package_manager == 'apt' and not err:
-                for line in result:
-                    for package in module.params['name']:
-                        if package in line:
-                            if "Unpacking" in line or "Removing" in line:
-                                results['changed'] = True
-                                # Substitute string using regular expression and remove CR
-                                invoked_package = re.sub(r'Unpacking|Removing', '', line).replace(' ...\r', '')
-                                response.add('{package} is {state}'.format(package=invoked_package, state=state))
-                            elif "aready" in line or "not installed" in line:
-                                response.add(line)
-
-            if not err:
-                results['results'] = list(sorted(response))
-
-        else:
-            err = True
-            results['msg'] = 'Package manager {package_manager} is not supported'.format(package_manager=package_manager)
+images:
+  type: list
+  when: "'image' is a list or a glob pattern"
+  description: Results of each image, same as returned for a single image, with the image path as 'image'
+  example: [
+      {"image": "/tmp/web-1.qcow2", "changed": true, "failed": false},
+      {"image": "/tmp/web-2.qcow2", "changed": false, "failed": true, "msg": "Could not find image"}
+  ]
 
-    elif module.params['list']:
-        app_regex = module.params['list']
-        if app_regex != "*":
-            app_query = True
-        else:
-            app_query = False
-        packages_list = []
-        for mount in guest.mounts():
-            apps = guest.inspect_list_applications2(mount)
-            if apps:
-                for app in apps:
-                    packages_list.append('{name}-{version}-{release}-{arch}'.format(name=app['app2_name'],
-                                                                                    version=app['app2_version'],
-                                                                                    release=app['app2_release'],
-                                                                                    arch=app['app2_arch']))
-                    if app_query:
-                        if not re.match(app_regex, app['app2_name']):
-                            del packages_list[-1]
-                break
+timings:
+  type: dict
+  when: profile is enabled
+  description: Duration in seconds of each phase
+  example: {
+      "launch": 2.481,
+      "inspect": 0.912,
+      "mount": 0.103,
+      "operation": 0.052,
+      "umount_sync": 0.087,
+      "shutdown": 0.215
+  }
+"""
 
-        if packages_list:
-            results['results'] = packages_list
-        else:
-            err = True
-            results['msg'] = "Packages containing regular expression '{regexp}' not found".format(regexp=app_regex)
+from ansible.module_utils.basic import AnsibleModule
+from ..module_utils.libguestfs import guest_argument_spec, run_operation
+from ..module_utils.operations import cached_inventory, package_transactions, packages
 
-    return results, err
+import os
 
 
 def main():
 
     mutual_exclusive_args = [
-        ['name', 'list'],
-        ['list', 'state']
+        ['name', 'list', 'packages'],
+        ['list', 'state'],
+        ['packages', 'state']
     ]
     required_togheter_args = [['name', 'state']]
-    required_one_of_args = [['name', 'list']]
+    required_one_of_args = [['name', 'list', 'packages']]
 
     module = AnsibleModule(
-        argument_spec=dict(
-            image=dict(required=True, type='str'),
-            automount=dict(required=False, type='bool', default=True),
-            mounts=dict(required=False,  type='list', elements='dict'),
-            network=dict(required=False, type='bool', default=True),
-            selinux_relabel=dict(required=False, type='bool', default=False),
+        argument_spec=guest_argument_spec(
             name=dict(required=False, type='list'),
-            state=dict(required=False, choices=['present', 'absent']),
+            state=dict(required=False, choices=['present', 'absent', 'latest']),
             list=dict(required=False, type='str'),
+            packages=dict(required=False, type='list', elements='dict'),
+            cache_valid_time=dict(required=False, type='int', default=0),
+            local_repo=dict(required=False, type='path'),
+            download_cache=dict(required=False, type='bool', default=False),
+            match=dict(required=False, choices=['regex', 'exact', 'prefix'], default='regex'),
+            inventory=dict(required=False, type='bool', default=False),
+            inventory_file=dict(required=False, type='path'),
         ),
         mutually_exclusive=mutual_exclusive_args,
         required_one_of=required_one_of_args,
@@ -254,10 +261,21 @@ def main():
         supports_check_mode=False
     )
 
-    g = guest(module)
-    instance = g.bootstrap()
-    results, err = packages(instance, module)
-    g.close()
+    # Validate requested packages before launching appliance
+    if not module.params['list']:
+        try:
+            package_transactions(module.params)
+        except ValueError as e:
+            module.fail_json(msg=str(e))
+    sources = []
+    if module.params['local_repo']:
+        if not os.path.isdir(module.params['local_repo']):
+            module.fail_json(msg="Local repository '{}' is not a directory".format(module.params['local_repo']))
+        sources.append(module.params['local_repo'])
+
+    # Listing packages does not modify guest disk image
+    results, err = run_operation(module, packages, readonly=bool(module.params['list']), sources=sources,
+                                 cached=cached_inventory)
 
     if err:
         module.fail_json(**results)
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = """
+module: guestfs_session
+short_description: Manage long lived appliance sessions
+version_added: '2.8'
+description:
+  - Starts a helper process which launches an appliance, mounts guest disk image and keeps it running
+  - Other modules attach to a started session using their 'session' option instead of launching their own appliance
+  - Changes to guest disk image are synced when session is stopped
+options:
+  session:
+    required: True
+    description: Path to UNIX socket the session is served on
+  state:
+    required: False
+    description: Whether session should be running
+    default: started
+    choices:
+    - started
+    - stopped
+  idle_timeout:
+    required: False
+    description: Seconds without any attached module after which session is stopped, 0 disables timeout
+    default: 3600
+  selinux_relabel:
+    required: False
+    description:
+      - Whether to perform SELinux context relabeling of paths changed through the session when it is stopped
+      - Attached modules only report the paths they changed when 'selinux_relabel' is enabled for them as well, otherwise the whole filesystem is relabeled
+    default: False
+extends_documentation_fragment:
+  - vkhitrin.libguestfs.libguestfs
+notes:
+  - Appliance options (automount, mounts, network, readonly, appliance tuning) of modules attached to a session are ignored
+  - Session socket is only accessible by the user which started it
+  - The session holds the lock on guest disk image (see 'image_lock') until it is stopped
+  - A session serves a single image, 'image' must be a path and not a list or a glob pattern
+requirements:
+  - "libguestfs"
+  - "libguestfs-devel"
+  - "python >= 2.7.5 || python >= 3.4"
+author:
+  - Vadim Khitrin (@vkhitrin)
+"""
+
+EXAMPLES = """
+- name: Start a session
+  guestfs_session:
+    image: /tmp/rhel7-5.qcow2
+    session: /tmp/rhel7-5.sock
+
+- name: Install a package using the session
+  guestfs_package:
+    image: /tmp/rhel7-5.qcow2
+    session: /tmp/rhel7-5.sock
+    name: vim
+    state: present
+
+- name: Stop the session and sync changes to guest disk image
+  guestfs_session:
+    image: /tmp/rhel7-5.qcow2
+    session: /tmp/rhel7-5.sock
+    state: stopped
+"""
+
+RETURN = """
+msg:
+  type: string
+  when: failure
+  description: Contains the error message (may include python exceptions)
+  example: "Could not find image"
+
+session:
+  type: string
+  when: always
+  description: Path to UNIX socket the session is served on
+  example: "/tmp/rhel7-5.sock"
+
+pid:
+  type: int
+  when: session is started
+  description: Process ID of session helper
+  example: 4242
+"""
+
+from ansible.module_utils.basic import AnsibleModule
+from ..module_utils.libguestfs import guest, guest_argument_spec, guest_module
+from ..module_utils.session import session_alive, session_info, start_session, stop_session
+
+import os
+
+
+def main():
+
+    module = AnsibleModule(
+        argument_spec=guest_argument_spec(
+            image=dict(required=True, type='str'),
+            session=dict(required=True, type='path'),
+            state=dict(required=False, choices=['started', 'stopped'], default='started'),
+            idle_timeout=dict(required=False, type='int', default=3600),
+        ),
+        supports_check_mode=False
+    )
+
+    path = module.params['session']
+    results = {
+        'changed': False,
+        'failed': False,
+        'session': path
+    }
+
+    if module.params['state'] == 'started':
+        if session_alive(path):
+            info = session_info(path)
+            if os.path.realpath(info['image']) != os.path.realpath(module.params['image']):
+                results['msg'] = 'Session {} serves image {}'.format(path, info['image'])
+                module.fail_json(**results)
+        else:
+            params = dict(module.params)
+            # Helper bootstraps the appliance itself, it must not attach to a session
+            params['session'] = None
+            g = guest(guest_module(params))
+            err = start_session(g, path, module.params['idle_timeout'])
+            if err:
+                results['msg'] = err
+                module.fail_json(**results)
+            results['changed'] = True
+            info = session_info(path)
+        results['pid'] = info['pid']
+
+    elif session_alive(path):
+        try:
+            stop_session(path)
+        except RuntimeError as e:
+            results['msg'] = str(e)
+            module.fail_json(**results)
+        results['changed'] = True
+
+    module.exit_json(**results)
+
+
+if __name__ == '__main__':
+    main()
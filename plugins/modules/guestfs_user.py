@@ -14,9 +14,6 @@ version_added: '2.8'
 description:
   - Manages users in guest image
 options:
-  image:
-    required: True
-    description: Image path on filesystem
   name:
     required: True
     description: Name of user to manage
@@ -29,20 +26,8 @@ options:
     choices:
     - present
     - absent
-  automount:
-    required: False
-    description: Whether to perform auto mount of mountpoints inside guest disk image
-    default: True
-  mounts:
-    required: False
-    description: "List of mounts that will be attempted. Each element is a dictionary {'/path/to/device': '/path/to/mountpoint'}"
-  selinux_relabel:
-    required: False
-    description: Whether to perform SELinux context relabeling
-  network:
-    required: False
-    description: Whether to enable network for appliance
-    default: True
+extends_documentation_fragment:
+  - vkhitrin.libguestfs.libguestfs
 requirements:
   - "libguestfs"
   - "libguestfs-devel"
@@ -88,76 +73,46 @@ results:
   example: [
       "test_user is present"
   ]
+
+lock_wait:
+  type: float
+  when: image_lock is enabled
+  description: Seconds spent waiting for the lock on guest disk image
+  example: 0.0
+
+images:
+  type: list
+  when: "'image' is a list or a glob pattern"
+  description: Results of each image, same as returned for a single image, with the image path as 'image'
+  example: [
+      {"image": "/tmp/web-1.qcow2", "changed": true, "failed": false},
+      {"image": "/tmp/web-2.qcow2", "changed": false, "failed": true, "msg": "Could not find image"}
+  ]
+
+timings:
+  type: dict
+  when: profile is enabled
+  description: Duration in seconds of each phase
+  example: {
+      "launch": 2.481,
+      "inspect": 0.912,
+      "mount": 0.103,
+      "operation": 0.052,
+      "umount_sync": 0.087,
+      "shutdown": 0.215
+  }
 """
 
 from ansible.module_utils.basic import AnsibleModule
-from ..module_utils.libguestfs import guest
-
-
-def users(guest, module):
-
-    state = module.params['state']
-    user_name = module.params['name']
-    user_password = module.params['password']
-    results = {
-        'changed': False,
-        'failed': False,
-        'results': []
-    }
-    err = False
-
-    try:
-        guest.sh_lines('id -u {}'.format(user_name))
-        user_exists = True
-    except Exception:
-        user_exists = False
-
-    if state == 'present':
-        if user_exists:
-            try:
-                guest.sh_lines('echo {u}:{p} | chpasswd'.format(u=user_name,
-                                                                p=user_password))
-            except Exception as e:
-                err = True
-                results['failed'] = True
-                results['msg'] = str(e)
-
-        else:
-            try:
-                guest.sh_lines('useradd {user}'.format(user=user_name))
-                guest.sh_lines('{u}:{p} | chpasswd'.format(u=user_name,
-                                                           p=user_password))
-            except Exception as e:
-                err = True
-                results['failed'] = True
-                results['msg'] = str(e)
-
-    elif state == 'absent':
-        if user_exists:
-            try:
-                guest.sh_lines('userdel {user}'.format(user=user_name))
-            except Exception as e:
-                err = True
-                results['failed'] = True
-                results['msg'] = str(e)
-
-    if not err:
-        results['changed'] = True
-        results['results'].append('{u} is {s}'.format(u=user_name, s=state))
-
-    return results, err
+from ..module_utils.libguestfs import guest_argument_spec, run_operation
+from ..module_utils.operations import users
 
 
 def main():
 
     required_togheter_args = [['name', 'state']]
     module = AnsibleModule(
-        argument_spec=dict(
-            image=dict(required=True, type='str'),
-            automount=dict(required=False, type='bool', default=True),
-            mounts=dict(required=False,  type='list', elements='dict'),
-            network=dict(required=False, type='bool', default=True),
-            selinux_relabel=dict(required=False, type='bool', default=False),
+        argument_spec=guest_argument_spec(
             name=dict(required=True, type='str'),
             password=dict(type='str', no_log=True),
             state=dict(required=True, choices=['present', 'absent']),
@@ -175,10 +130,7 @@ def main():
         }
         module.fail_json(**results)
 
-    g = guest(module)
-    instance = g.bootstrap()
-    results, err = users(instance, module)
-    g.close()
+    results, err = run_operation(module, users, sources=[])
 
     if err:
         module.fail_json(**results)
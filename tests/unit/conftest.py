@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Unit tests run module operations against 'fake_guestfs' of the benchmarks,
+no appliance or guest disk image is required."""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+
+import fake_guestfs  # noqa: E402
+
+sys.modules['guestfs'] = fake_guestfs
+
+
+@pytest.fixture(autouse=True)
+def no_latency(monkeypatch):
+    for phase in list(fake_guestfs.LATENCIES):
+        monkeypatch.setitem(fake_guestfs.LATENCIES, phase, 0)
+
+
+@pytest.fixture
+def params(tmp_path):
+    """Returns module parameters for a fake image, updated with keyword arguments."""
+
+    image = tmp_path / 'image.qcow2'
+    image.write_bytes(b'')
+
+    def build(**kwargs):
+        module_params = {
+            'image': str(image),
+            'automount': True,
+            'mounts': None,
+            'network': False,
+            'selinux_relabel': False,
+            'readonly': None,
+            'inspection_cache': False,
+            'cache_dir': str(tmp_path / 'cache'),
+            'session': None,
+        }
+        module_params.update(kwargs)
+        return module_params
+    return build
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import pytest
+
+from plugins.module_utils.libguestfs import guest, guest_module
+
+
+def appliance_settings(params):
+    g = guest(guest_module(params)).bootstrap()
+    try:
+        return dict(g.handle.settings)
+    finally:
+        g.close()
+
+
+@pytest.mark.parametrize('package', [
+    {'local_repo': '/srv/repo'},
+    {'steps': [{'shell': 'true'}, {'package': {'name': 'vim', 'local_repo': '/srv/repo'}}]},
+])
+def test_local_repo_disables_network(params, package):
+    assert appliance_settings(params(network=True, **package)).get('network') is None
+
+
+def test_network_enabled_without_local_repo(params):
+    steps = [{'package': {'name': 'vim'}}]
+    assert appliance_settings(params(network=True, steps=steps)).get('network') is True
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import os
+
+import pytest
+
+from plugins.module_utils.libguestfs import guest, guest_module
+from plugins.module_utils.operations import download, list_packages, upload, upload_files
+
+
+def tree(root):
+    # Relative paths of files under root
+    return sorted(os.path.relpath(os.path.join(dirpath, name), root)
+                  for dirpath, dirnames, filenames in os.walk(root) for name in filenames)
+
+
+def run(operation, params, files=None):
+    # Returns results of operation and the files of guest filesystem,
+    # 'files' are created in guest filesystem beforehand
+    module = guest_module(params)
+    g = guest(module).bootstrap()
+    try:
+        for path, content in (files or {}).items():
+            g.mkdir_p(os.path.dirname(path))
+            g.write(path, content)
+        results, err = operation(g, module)
+        assert not err, results
+        return results, tree(g.handle.sysroot)
+    finally:
+        g.close()
+
+
+@pytest.fixture
+def logs(tmp_path):
+    directory = tmp_path / 'logs'
+    (directory / 'nested').mkdir(parents=True)
+    (directory / 'a.log').write_text(u'a')
+    (directory / 'nested' / 'b.log').write_text(u'b')
+    return str(directory)
+
+
+@pytest.mark.parametrize('separator', ['', os.path.sep])
+@pytest.mark.parametrize('mode', [{'incremental': True}, {'compression': 'gzip'}])
+def test_upload_layout_matches_copy_in(params, logs, separator, mode):
+    transfer = dict(src=logs + separator, dest='/tmp/', recursive=True, incremental=False, compression='none')
+    dummy, plain = run(upload, params(**transfer))
+    transfer.update(mode)
+    dummy, layout = run(upload, params(**transfer))
+    assert plain == ['tmp/logs/a.log', 'tmp/logs/nested/b.log']
+    assert layout == plain
+
+
+@pytest.mark.parametrize('separator', ['', '/'])
+@pytest.mark.parametrize('mode', [{'incremental': True}, {'compression': 'gzip'}])
+def test_download_layout_matches_copy_out(params, tmp_path, separator, mode):
+    files = {'/var/log/app/a.log': b'a', '/var/log/app/nested/b.log': b'b'}
+
+    def layout(name, **transfer):
+        dest = tmp_path / name
+        dest.mkdir()
+        transfer = dict(dict(incremental=False, compression='none'), **transfer)
+        run(download, params(src='/var/log/app' + separator, dest=str(dest) + os.path.sep, recursive=True,
+                             **transfer), files)
+        return tree(str(dest))
+
+    # copy_out copies the directory itself, plain downloads without a
+    # trailing separator nest it once more in dest (kept for compatibility)
+    assert layout('changed', **mode) == ['app/a.log', 'app/nested/b.log']
+    if separator:
+        assert layout('plain') == ['app/a.log', 'app/nested/b.log']
+
+
+def test_files_transfer_rate_of_fast_items(params, tmp_path):
+    files = []
+    for index in range(3):
+        src = tmp_path / 'file{}'.format(index)
+        src.write_bytes(b'x' * 1024)
+        files.append({'src': str(src), 'dest': '/file{}'.format(index)})
+    results, dummy = run(upload_files, params(src=None, dest=None, files=files, recursive=False, incremental=False,
+                                              compression='none', checksum_algorithm='md5'))
+    assert results['transfer']['bytes'] == 3 * 1024
+    assert results['transfer']['mb_per_second'] is not None
+
+
+@pytest.mark.parametrize('match, message', [
+    ('regex', "Packages containing regular expression 'nginx' not found"),
+    ('exact', "Package 'nginx' not found"),
+    ('prefix', "Packages starting with 'nginx' not found"),
+])
+def test_list_packages_not_found_message(match, message):
+    results, err = list_packages([], {'list': 'nginx', 'match': match})
+    assert err
+    assert results['msg'] == message
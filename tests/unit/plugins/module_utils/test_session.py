@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+# Copyright: (c) 2021, Vadim Khitrin <me at vkhitrin.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import socket
+import threading
+
+import pytest
+
+from plugins.module_utils.libguestfs import guest, guest_module
+from plugins.module_utils.session import SessionClient, _serve
+
+
+@pytest.fixture
+def client(params, tmp_path):
+    # Serves a bootstrapped guest in a thread instead of a detached helper
+    g = guest(guest_module(params())).bootstrap()
+    path = str(tmp_path / 'session.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    thread = threading.Thread(target=_serve, args=(g, server, path, 0))
+    thread.start()
+    session = SessionClient(path)
+    yield session
+    session.call('__stop__')
+    session.close()
+    thread.join()
+
+
+def test_operation_calls_are_served(client):
+    client.mkdir_p('/etc')
+    client.write('/etc/motd', b'hello')
+    assert client.read_file('/etc/motd') == b'hello'
+    assert client.inspect_get_distro('/dev/sda1') == 'fedora'
+    assert client.once('refresh') is True
+
+
+@pytest.mark.parametrize('method', ['umount_all', 'umount', 'sync', 'shutdown', 'close', 'add_drive_opts',
+                                    'mount_filesystems', 'unlock_image', 'discard_overlay', 'relabel', '_inspected'])
+def test_lifecycle_calls_are_rejected(client, method):
+    with pytest.raises(RuntimeError, match='can not be called on a session'):
+        client.call(method, '/')